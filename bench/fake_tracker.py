@@ -0,0 +1,164 @@
+# encoding=utf8
+'''
+A stand-in for the tracker, for benchmarking the pipeline offline.
+
+It hands out a fixed, seeded list of items (single or multi=N requests),
+answers upload requests with an rsync target and records done items and
+their stats. Point the pipeline at it with
+--context-value tracker_host=HOST:PORT.
+
+Run it on its own with
+
+  python bench/fake_tracker.py --port 8081 --items 100 \
+      --mix wallpaper=8,tag=1,user=1 --upload-target rsync://127.0.0.1:8873/bench/
+'''
+import argparse
+import json
+import random
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+TRACKER_ID = 'wallbase'
+
+# How items of each type look, see get_item_urls in pipeline.py.
+ITEM_FORMATS = {
+    'wallpaper': lambda rng: 'wallpaper:%d' % rng.randint(1, 3000000),
+    'tag': lambda rng: 'tag:%d' % rng.randint(1, 30000),
+    'user': lambda rng: 'user:%d' % rng.randint(1, 600000),
+    'collection': lambda rng: 'collection:%d' % rng.randint(1, 30000),
+    'color': lambda rng: 'color:%06x' % rng.randint(0, 0xffffff),
+    'toplist': lambda rng: 'toplist:%s' % rng.choice(['1d', '3d', '1w', '2w', '1m', '3m']),
+    'screenshot': lambda rng: 'screenshot:%d' % rng.randint(1, 5000),
+    'favorite': lambda rng: 'favorite:%d' % rng.randint(1, 600000),
+}
+
+
+def parse_mix(text):
+    '''
+    Parses "wallpaper=8,tag=1" into [('wallpaper', 8.0), ('tag', 1.0)].
+    '''
+    mix = []
+    for part in text.split(','):
+        item_type, weight = part.split('=', 1)
+        if item_type not in ITEM_FORMATS:
+            raise ValueError('Unknown item type %r.' % item_type)
+        mix.append((item_type, float(weight)))
+    return mix
+
+
+def make_items(count, mix, seed):
+    rng = random.Random(seed)
+    total = sum(weight for item_type, weight in mix)
+    items = []
+    while len(items) < count:
+        x = rng.uniform(0, total)
+        for item_type, weight in mix:
+            if x <= weight:
+                break
+            x -= weight
+        item_name = ITEM_FORMATS[item_type](rng)
+        if item_name not in items:
+            items.append(item_name)
+    return items
+
+
+class Tracker(object):
+    '''
+    The item queue and what was reported back.
+    '''
+    def __init__(self, items, upload_target):
+        self.todo = list(items)
+        self.upload_target = upload_target
+        self.claimed = {}
+        self.done = {}
+        self.uploads = 0
+        self._lock = threading.Lock()
+
+    def request(self, count):
+        with self._lock:
+            item_names = self.todo[:count]
+            del self.todo[:count]
+            for item_name in item_names:
+                self.claimed[item_name] = time.time()
+        return item_names
+
+    def upload(self):
+        with self._lock:
+            self.uploads += 1
+        return self.upload_target
+
+    def mark_done(self, item_names, stats):
+        with self._lock:
+            for item_name in item_names:
+                self.claimed.pop(item_name, None)
+                self.done[item_name] = stats
+
+
+class TrackerHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        tracker = self.server.tracker
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        data = json.loads(body.decode('utf8')) if body else {}
+
+        m = re.match(r'^/%s(?:/multi=([0-9]+))?/+(request|upload|done)$' % TRACKER_ID, self.path)
+        if not m:
+            self.respond(404, 'Not found')
+        elif m.group(2) == 'request':
+            item_names = tracker.request(int(m.group(1) or 1))
+            if item_names:
+                self.respond(200, json.dumps({'item_name': '\0'.join(item_names)}))
+            else:
+                self.respond(404, 'No items')
+        elif m.group(2) == 'upload':
+            self.respond(200, json.dumps({'upload_target': tracker.upload()}))
+        else:
+            tracker.mark_done(data.get('item', '').split('\0'), data)
+            self.respond(200, 'OK')
+
+    def respond(self, status_code, body):
+        body = body.encode('utf8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, tracker):
+        HTTPServer.__init__(self, address, TrackerHandler)
+        self.tracker = tracker
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--mix', default='wallpaper=8,tag=1,user=1')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--upload-target', required=True)
+    args = parser.parse_args()
+
+    items = make_items(args.items, parse_mix(args.mix), args.seed)
+    server = Server((args.address, args.port), Tracker(items, args.upload_target))
+    print('Serving the %s tracker on %s:%d' % (TRACKER_ID, args.address, args.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+# encoding=utf8
+'''
+A stand-in for wallbase.cc and its image hosts, for benchmarking the
+pipeline offline.
+
+It is an HTTP proxy: Wget is pointed at it with
+--context-value http_proxy=HOST:PORT and every request for wallbase.cc,
+walb.es, wallpapers.wallbase.cc, the thumbnail hosts and
+slave.wallbase.cc is answered here. The pages carry just enough markup
+for wallbase.lua (wallpaper images, prev/next links, search results and
+"The End"); they are made up, not copies of real wallbase.cc pages.
+
+Everything a response contains depends only on the URL and the seed, so
+two runs with the same options serve the same site:
+
+* every wallpaper has one category and extension; the full image exists
+  only there, so probes for the other ones get a 404,
+* each thumbnail host has a wallpaper's thumbnail with probability
+  1 - thumb_404_ratio,
+* a wallpaper page shows its full image with probability
+  1 - hidden_image_ratio (otherwise wallbase.lua has to probe for it),
+* a wallpaper page is gone (404) with probability gone_page_ratio,
+  while its images are still there,
+* the prev/next links (wallpaper/go/ID/prev and next) redirect to the
+  page of wallpaper ID-1 or ID+1,
+* a search has between 0 and max_results results,
+* requests from the throttled_addresses get a 429, to try the bind
+  address pool with loopback aliases (127.0.0.x).
+
+Run it on its own with
+
+  python bench/fake_wallbase.py --port 8080
+'''
+import argparse
+import hashlib
+import random
+import re
+import threading
+import time
+
+try:
+    from urllib.parse import urlsplit, parse_qs
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from urlparse import urlsplit, parse_qs
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+CATEGORIES = ['high-resolution', 'manga-anime', 'rozne']
+EXTENSIONS = [('jpg', 0.8), ('png', 0.15), ('gif', 0.05)]
+THUMB_HOSTS = ['origthumbs', 'thumbs', 'sthumbs']
+HTML = 'text/html; charset=utf-8'
+
+
+class Site(object):
+    '''
+    The content of the fake site and the counters of what was served.
+    '''
+    def __init__(self, seed=1, page_size=20000, image_size=500000,
+                 page_latency=0.2, image_latency=0.05, thumb_404_ratio=0.3,
+                 hidden_image_ratio=0.1, gone_page_ratio=0.02,
+                 max_results=500, throttled_addresses=()):
+        self.seed = seed
+        self.page_size = page_size
+        self.image_size = image_size
+        self.page_latency = page_latency
+        self.image_latency = image_latency
+        self.thumb_404_ratio = thumb_404_ratio
+        self.hidden_image_ratio = hidden_image_ratio
+        self.gone_page_ratio = gone_page_ratio
+        self.max_results = max_results
+        self.throttled_addresses = set(throttled_addresses)
+
+        # Random, so that the WARCs compress like real images do.
+        rng = random.Random(seed)
+        self._noise = bytearray(rng.getrandbits(8) for i in range(1024 * 1024))
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.status_codes = {}
+        self.client_requests = {}
+
+    def _random(self, *key):
+        digest = hashlib.sha1(repr((self.seed,) + key).encode('utf8')).digest()
+        return random.Random(digest)
+
+    def wallpaper(self, wallpaper_id):
+        rng = self._random('wallpaper', wallpaper_id)
+        category = rng.choice(CATEGORIES)
+        extension = 'jpg'
+        x = rng.random()
+        for extension, weight in EXTENSIONS:
+            if x < weight:
+                break
+            x -= weight
+        thumb_hosts = [host for host in THUMB_HOSTS
+            if rng.random() >= self.thumb_404_ratio]
+        return {
+            'category': category,
+            'extension': extension,
+            'thumb_hosts': thumb_hosts,
+            'image_shown': rng.random() >= self.hidden_image_ratio,
+            'image_size': int(self.image_size * rng.uniform(0.5, 1.5)),
+            'page_gone': rng.random() < self.gone_page_ratio,
+        }
+
+    def result_count(self, query):
+        return self._random('search', query).randint(0, self.max_results)
+
+    def noise(self, size):
+        chunks = []
+        while size > 0:
+            chunk = self._noise[:size]
+            chunks.append(bytes(chunk))
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def page(self, title, body):
+        html = (
+            '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+            '<title>%s - wallbase.cc</title>\n</head>\n<body>\n%s\n'
+            % (title, body))
+        padding = max(0, self.page_size - len(html) - 20)
+        return (html + '<!-- %s -->\n</body>\n</html>\n' % ('x' * padding)).encode('utf8')
+
+    def thumbnails(self, first_id, count):
+        lines = []
+        for wallpaper_id in range(first_id, first_id + count):
+            wallpaper = self.wallpaper(str(wallpaper_id))
+            lines.append(
+                '<div class="thumbnail"><a href="http://wallbase.cc/wallpaper/%d">'
+                '<img data-original="http://thumbs.wallbase.cc//%s/thumb-%d.jpg" '
+                'src="http://wallbase.cc/img/blank.gif" class="file" alt=""></a></div>'
+                % (wallpaper_id, wallpaper['category'], wallpaper_id))
+        return '\n'.join(lines)
+
+    def wallpaper_page(self, wallpaper_id):
+        wallpaper = self.wallpaper(wallpaper_id)
+        body = []
+        if wallpaper['image_shown']:
+            body.append(
+                '<img src="http://wallpapers.wallbase.cc/%s/wallpaper-%s.%s" '
+                'class="wall stage1 wide" alt="">'
+                % (wallpaper['category'], wallpaper_id, wallpaper['extension']))
+        for direction in ('prev', 'next'):
+            body.append(
+                '<a href="http://wallbase.cc/wallpaper/go/%s/%s?ref=YmVuY2g" '
+                'class="%s-wall">%s</a>'
+                % (wallpaper_id, direction, direction, direction.upper()))
+        body.append(self.thumbnails(int(wallpaper_id) * 7 % 3000000, 8))
+        return self.page('Wallpaper', '\n'.join(body))
+
+    def search_page(self, query, offset, per_page):
+        total = self.result_count(query)
+        if total == 0:
+            return self.page('Search',
+                '<div class="subtitle">There seems to be nothing here. Move along...</div>')
+        if offset >= total:
+            return self.page('Search', '<div class="title">The End</div>')
+        first_id = self._random('first', query).randint(1, 3000000)
+        return self.page('Search',
+            self.thumbnails(first_id + offset, min(per_page, total - offset)))
+
+    def respond(self, url):
+        '''
+        Returns (status code, content type, body, latency, location) for
+        a URL. The location is None unless it is a redirect.
+        '''
+        parts = urlsplit(url)
+        host = parts.hostname or ''
+        path = re.sub('/+', '/', parts.path)
+        query = parse_qs(parts.query)
+
+        if host == 'wallpapers.wallbase.cc':
+            m = re.match(r'^/([a-z-]+)/wallpaper-([0-9]+)\.([a-z]+)$', path)
+            if m:
+                wallpaper = self.wallpaper(m.group(2))
+                if (m.group(1), m.group(3)) == (wallpaper['category'], wallpaper['extension']):
+                    return 200, 'image/' + {'jpg': 'jpeg'}.get(m.group(3), m.group(3)), self.noise(wallpaper['image_size']), self.image_latency, None
+            return 404, HTML, b'', self.image_latency, None
+
+        if host.endswith('.wallbase.cc') and host.split('.')[0] in THUMB_HOSTS:
+            m = re.match(r'^/([a-z-]+)/thumb-([0-9]+)\.jpg$', path)
+            if m:
+                wallpaper = self.wallpaper(m.group(2))
+                if m.group(1) == wallpaper['category'] and \
+                        host.split('.')[0] in wallpaper['thumb_hosts']:
+                    return 200, 'image/jpeg', self.noise(wallpaper['image_size'] // 50), self.image_latency, None
+            return 404, HTML, b'', self.image_latency, None
+
+        if host in ('wallbase.cc', 'walb.es'):
+            m = re.match(r'^/wallpaper/([0-9]+)$', path)
+            if host == 'wallbase.cc' and m:
+                if self.wallpaper(m.group(1))['page_gone']:
+                    return 404, HTML, self.page('Not found', ''), self.page_latency, None
+                return 200, HTML, self.wallpaper_page(m.group(1)), self.page_latency, None
+
+            m = re.match(r'^/wallpaper/go/([0-9]+)/(prev|next)/?$', path)
+            if host == 'wallbase.cc' and m:
+                neighbour = max(1, int(m.group(1)) + (1 if m.group(2) == 'next' else -1))
+                return 302, HTML, b'', self.page_latency, 'http://wallbase.cc/wallpaper/%d' % neighbour
+
+            m = re.match(r'^/search(?:/index)?/?([0-9]*)$', path)
+            if host == 'wallbase.cc' and m and ('tag' in query or 'q' in query):
+                search = 'tag=%s' % query['tag'][0] if 'tag' in query else 'q=%s' % query['q'][0]
+                per_page = 60 if '/index' not in path and m.group(1) else 32
+                return 200, HTML, self.search_page(search, int(m.group(1) or 0), per_page), self.page_latency, None
+
+            if path.startswith('/images/'):
+                return 404, HTML, b'', self.page_latency, None
+
+            return 200, HTML, self.page('wallbase.cc', ''), self.page_latency, None
+
+        return 404, HTML, b'', self.image_latency, None
+
+    def count(self, client_address, status_code, size):
+        with self._lock:
+            self.requests += 1
+            self.client_requests[client_address] = self.client_requests.get(client_address, 0) + 1
+            self.bytes += size
+            self.status_codes[status_code] = self.status_codes.get(status_code, 0) + 1
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = self.path
+        if url.startswith('/'):
+            url = 'http://%s%s' % (self.headers.get('Host', 'wallbase.cc'), url)
+
+        site = self.server.site
+        if self.client_address[0] in site.throttled_addresses:
+            status_code, content_type, body, latency, location = 429, HTML, b'', 0, None
+        else:
+            status_code, content_type, body, latency, location = site.respond(url)
+        time.sleep(latency)
+
+        self.send_response(status_code)
+        if location:
+            self.send_header('Location', location)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        site.count(self.client_address[0], status_code, len(body))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, site):
+        HTTPServer.__init__(self, address, ProxyHandler)
+        self.site = site
+
+
+def add_arguments(parser):
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--page-size', type=int, default=20000,
+        help='size of the HTML pages in bytes')
+    parser.add_argument('--image-size', type=int, default=500000,
+        help='average size of the full images in bytes')
+    parser.add_argument('--page-latency', type=float, default=0.2,
+        help='seconds before a page is sent')
+    parser.add_argument('--image-latency', type=float, default=0.05,
+        help='seconds before an image or 404 is sent')
+    parser.add_argument('--thumb-404-ratio', type=float, default=0.3)
+    parser.add_argument('--hidden-image-ratio', type=float, default=0.1)
+    parser.add_argument('--gone-page-ratio', type=float, default=0.02)
+    parser.add_argument('--max-results', type=int, default=500,
+        help='maximum number of results of a search')
+    parser.add_argument('--throttled-addresses', default='',
+        help='answer requests from these client addresses with 429')
+
+
+def site_from_args(args):
+    return Site(seed=args.seed, page_size=args.page_size,
+        image_size=args.image_size, page_latency=args.page_latency,
+        image_latency=args.image_latency,
+        thumb_404_ratio=args.thumb_404_ratio,
+        hidden_image_ratio=args.hidden_image_ratio,
+        gone_page_ratio=args.gone_page_ratio,
+        max_results=args.max_results,
+        throttled_addresses=[address for address
+            in args.throttled_addresses.split(',') if address])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = Server((args.address, args.port), site_from_args(args))
+    print('Serving wallbase.cc as a proxy on %s:%d' % (args.address, args.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+-- Micro-benchmark for wget.callbacks.get_urls in wallbase.lua.
+--
+-- Runs the callback over the synthetic pages in bench/fixtures (see
+-- bench/README.md) and prints the CPU time it takes per page. Run it
+-- from the repository root:
+--
+--   lua bench/get_urls_bench.lua [iterations]
+--
+-- get_urls remembers the pages it queued and the wallpapers it planned,
+-- so every iteration loads wallbase.lua again and only the get_urls
+-- call itself is timed. Otherwise all but the first call would find
+-- nothing new and be much cheaper than a real one.
+
+local iterations = tonumber(arg and arg[1]) or 500
+
+local fixtures = {
+  { file="bench/fixtures/wallpaper.html", url="http://wallbase.cc/wallpaper/2816669",
+    item="wallpaper:2816669" },
+  { file="bench/fixtures/search.html", url="http://wallbase.cc/search/index/32?tag=8179",
+    item="tag:8179" },
+  { file="bench/fixtures/search-end.html", url="http://wallbase.cc/search/index/64?tag=8179",
+    item="tag:8179" },
+  { file="bench/fixtures/search.html", url="http://wallbase.cc/search/index/32?q==(fate stay night)",
+    item="tag:8179:fate stay night" },
+}
+
+-- wallbase.lua only plans the images of a wallpaper that is an item, and
+-- finds its items in item_dir/item_urls.txt.
+local item_dir = os.tmpname()
+os.remove(item_dir)
+os.execute("mkdir " .. item_dir)
+local f = assert(io.open(item_dir .. "/item_urls.txt", "w"))
+for _, fixture in ipairs(fixtures) do
+  f:write(fixture["item"] .. "\t" .. fixture["url"] .. "\n")
+end
+f:close()
+
+local getenv = os.getenv
+os.getenv = function(name)
+  if name == "item_dir" then
+    return item_dir
+  end
+  return getenv(name)
+end
+
+-- Just enough of the wget-lua API for wallbase.lua to load.
+wget = {
+  callbacks={},
+  actions={ NOTHING=0, CONTINUE=1, EXIT=2, ABORT=3 },
+}
+
+-- wallbase.lua writes its progress lines to stdout, which would bury the
+-- results.
+local stdout = io.stdout
+io.stdout = { write=function() end, flush=function() end }
+
+local results = {}
+
+for _, fixture in ipairs(fixtures) do
+  local new_urls = nil
+  local elapsed = 0
+  for i = 1, iterations do
+    dofile("wallbase.lua")
+    -- get_urls only follows pagination after a 200 response.
+    wget.callbacks.httploop_result({ url=fixture["url"], host="bench.invalid" }, nil, { statcode=200 })
+
+    local start = os.clock()
+    local urls = wget.callbacks.get_urls(fixture["file"], fixture["url"], false, nil)
+    elapsed = elapsed + os.clock() - start
+
+    new_urls = new_urls or #urls
+  end
+
+  table.insert(results, string.format("%-60s %8d %12.1f", string.sub(fixture["url"], 1, 60), new_urls,
+    elapsed / iterations * 1000000))
+end
+
+for _, name in ipairs({ "item_urls.txt", "manifest.txt", "url_plan_deltas.jsonl", "url_metrics.jsonl" }) do
+  os.remove(item_dir .. "/" .. name)
+end
+os.remove(item_dir)
+
+io.stdout = stdout
+io.stdout:write(string.format("%-60s %8s %12s", "url", "new urls", "us/page") .. "\n")
+io.stdout:write(table.concat(results, "\n") .. "\n")
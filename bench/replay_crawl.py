@@ -0,0 +1,269 @@
+# encoding=utf8
+'''
+Replays the crawl of wallbase.lua against the fake site, without Wget,
+to compare what ends up in the WARC.
+
+The start URLs are fetched one at a time from bench/fake_wallbase.py,
+every response goes through the script's httploop_result, redirects are
+followed right away, get_urls sees where they end, and the URLs it
+returns are queued, each URL once, like Wget does. Wget's own link
+extraction (--page-requisites) and download_child_p are left out. The script
+runs in lupa's Lua 5.1 (pip install lupa) with a stand-in for luasocket
+whose clock only moves while the script sleeps.
+
+For wallpaper items, the image URLs that got a 200 are compared with
+those of the old URL list, which requested every category, extension
+and thumbnail variant of a wallpaper up front:
+
+  python bench/replay_crawl.py --items 1000
+'''
+import argparse
+import collections
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import lupa.lua51
+
+import fake_tracker
+import fake_wallbase
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAX_REDIRECTS = 20
+IMAGE_HOSTS = ('wallpapers.wallbase.cc', 'origthumbs.wallbase.cc',
+    'thumbs.wallbase.cc', 'sthumbs.wallbase.cc')
+
+WGET_STUB = '''
+wget = {
+  callbacks={},
+  actions={ NOTHING=0, CONTINUE=1, EXIT=2, ABORT=3 },
+}
+io.stdout = { write=function() end, flush=function() end }
+'''
+SOCKET_STUB = '''
+function(gettime, sleep)
+  package.preload["socket"] = function()
+    return { gettime=gettime, sleep=sleep }
+  end
+end
+'''
+
+
+def wallpaper_start_urls(wallpaper_id):
+    '''The wallbase.cc page URLs of get_item_urls in pipeline.py.'''
+    return [url.format(wallpaper_id) for url in [
+        'http://wallbase.cc/wallpaper/{0}',
+        'http://wallbase.cc/wallpaper/go/{0}/next',
+        'http://wallbase.cc/wallpaper/go/{0}/prev',
+    ]]
+
+
+def old_image_urls(wallpaper_id):
+    '''The image URLs the pipeline requested for a wallpaper before.'''
+    urls = []
+    for extension in ('jpg', 'png', 'gif'):
+        for category in ('high-resolution', 'manga-anime', 'rozne'):
+            urls.append('http://wallpapers.wallbase.cc/%s/wallpaper-%s.%s' % (
+                category, wallpaper_id, extension))
+    for slash in ('//', '/'):
+        for host in ('origthumbs', 'thumbs', 'sthumbs'):
+            for category in ('rozne', 'high-resolution', 'manga-anime'):
+                urls.append('http://%s.wallbase.cc%s%s/thumb-%s.jpg' % (
+                    host, slash, category, wallpaper_id))
+    return urls
+
+
+class Script(object):
+    '''
+    wallbase.lua loaded for a single Wget run of an item.
+    '''
+    def __init__(self, item_dir, url_plan_index, item_urls):
+        with open(os.path.join(item_dir, 'item_urls.txt'), 'w') as f:
+            for item_name, url in item_urls:
+                f.write('%s\t%s\n' % (item_name, url))
+        os.environ['item_dir'] = item_dir
+        os.environ['url_plan_index'] = url_plan_index
+
+        self.clock = 0.0
+        self.lua = lupa.lua51.LuaRuntime()
+        self.lua.execute(WGET_STUB)
+        self.lua.eval(SOCKET_STUB)(self._gettime, self._sleep)
+
+        cwd = os.getcwd()
+        os.chdir(REPO)
+        try:
+            with open('wallbase.lua') as f:
+                self.lua.execute(f.read())
+        finally:
+            os.chdir(cwd)
+
+        self.wget = self.lua.globals().wget
+
+    def _gettime(self):
+        return self.clock
+
+    def _sleep(self, seconds):
+        self.clock += seconds
+
+    def table(self, **fields):
+        return self.lua.table_from(fields)
+
+
+def crawl(script, site, start_urls, files_dir):
+    '''
+    Fetches the start URLs and whatever the script adds. Returns
+    [(url, status code)] in the order they were fetched.
+    '''
+    actions = script.wget.actions
+    callbacks = script.wget.callbacks
+    queue = collections.deque(start_urls)
+    seen = set(start_urls)
+    fetched = []
+    filename = os.path.join(files_dir, 'wget.tmp')
+
+    while queue:
+        url = queue.popleft()
+        for redirects in range(MAX_REDIRECTS + 1):
+            status_code, content_type, body, latency, location = site.respond(url)
+            with open(filename, 'wb') as f:
+                f.write(body)
+            script.clock += latency
+
+            action = callbacks.httploop_result(
+                script.table(url=url, host=urlsplit(url).hostname), None,
+                script.table(statcode=status_code, len=len(body),
+                    dltime=latency, newloc=location))
+            fetched.append((url, status_code))
+            if action != actions.NOTHING or location is None:
+                break
+            url = location
+
+        if action == actions.ABORT:
+            break
+        if action == actions.EXIT:
+            # Wget gives up on this URL and goes on with the next.
+            continue
+        if action == actions.CONTINUE:
+            queue.appendleft(url)
+            continue
+        if redirects > 0:
+            # Wget does not descend into a redirect target it has
+            # queued or fetched already.
+            if url in seen:
+                continue
+            seen.add(url)
+
+        for new_url in callbacks.get_urls(filename, url, False, None).values():
+            if new_url.url not in seen:
+                seen.add(new_url.url)
+                queue.append(new_url.url)
+
+    callbacks.finish(0, 0, 0, len(fetched), 0, 0)
+    return fetched
+
+
+def merge_plan_deltas(item_dir, url_plan_index):
+    '''Adds the hit counts of a run to the index, as the pipeline does.'''
+    deltas_file = os.path.join(item_dir, 'url_plan_deltas.jsonl')
+    if not os.path.exists(deltas_file):
+        return
+    stats = {}
+    if os.path.exists(url_plan_index):
+        with open(url_plan_index) as f:
+            stats = json.load(f)
+    with open(deltas_file) as f:
+        for line in f:
+            for key, counts in json.loads(line).items():
+                entry = stats.setdefault(key, {'hits': 0, 'tries': 0})
+                entry['hits'] += counts['hits']
+                entry['tries'] += counts['tries']
+    with open(url_plan_index, 'w') as f:
+        json.dump(stats, f)
+
+
+def image_urls(fetched):
+    return [(url, status_code) for url, status_code in fetched
+        if urlsplit(url).hostname in IMAGE_HOSTS]
+
+
+def compare_wallpapers(site, wallpaper_ids, workdir):
+    url_plan_index = os.path.join(workdir, 'url-plan-index.json')
+    result = {
+        'items': 0,
+        'mismatches': [],
+        'old_image_requests': 0,
+        'new_image_requests': 0,
+        'image_responses': 0,
+    }
+
+    for wallpaper_id in wallpaper_ids:
+        item_dir = tempfile.mkdtemp(dir=workdir)
+        start_urls = wallpaper_start_urls(wallpaper_id)
+        script = Script(item_dir, url_plan_index,
+            [('wallpaper:' + wallpaper_id, url) for url in start_urls])
+        new_fetched = image_urls(crawl(script, site, start_urls, item_dir))
+        merge_plan_deltas(item_dir, url_plan_index)
+        shutil.rmtree(item_dir)
+
+        old_fetched = [(url, site.respond(url)[0])
+            for url in old_image_urls(wallpaper_id)]
+
+        old_found = set(url for url, status_code in old_fetched if status_code == 200)
+        new_found = set(url for url, status_code in new_fetched if status_code == 200)
+        if old_found != new_found:
+            result['mismatches'].append({
+                'wallpaper': wallpaper_id,
+                'only_old': sorted(old_found - new_found),
+                'only_new': sorted(new_found - old_found),
+            })
+
+        result['items'] += 1
+        result['old_image_requests'] += len(old_fetched)
+        result['new_image_requests'] += len(new_fetched)
+        result['image_responses'] += len(old_found)
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--items', type=int, default=200)
+    parser.add_argument('--keep-workdir', action='store_true')
+    fake_wallbase.add_arguments(parser)
+    args = parser.parse_args()
+
+    site = fake_wallbase.site_from_args(args)
+    wallpaper_ids = [item_name.split(':', 1)[1] for item_name
+        in fake_tracker.make_items(args.items, [('wallpaper', 1)], args.seed)]
+
+    workdir = tempfile.mkdtemp(prefix='wallbase-replay-')
+    try:
+        result = compare_wallpapers(site, wallpaper_ids, workdir)
+    finally:
+        if args.keep_workdir:
+            print('Kept %s' % workdir)
+        else:
+            shutil.rmtree(workdir)
+
+    print('%-28s %12d' % ('wallpaper items', result['items']))
+    print('%-28s %12d' % ('image URLs found', result['image_responses']))
+    print('%-28s %12d' % ('image requests, old list', result['old_image_requests']))
+    print('%-28s %12d' % ('image requests, URL plan', result['new_image_requests']))
+    print('%-28s %12d' % ('items with other URLs', len(result['mismatches'])))
+    for mismatch in result['mismatches'][:10]:
+        print(json.dumps(mismatch, sort_keys=True))
+
+    if result['mismatches']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
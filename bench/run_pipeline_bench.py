@@ -0,0 +1,305 @@
+# encoding=utf8
+'''
+End-to-end throughput benchmark of the pipeline.
+
+Runs the real pipeline.py with run-pipeline against bench/fake_wallbase.py
+(as Wget's HTTP proxy), bench/fake_tracker.py and a local rsync daemon,
+and reports items/hour, the average time items spent in each task (from
+metrics.prom) and the bytes downloaded and uploaded.
+
+Every run starts from a fresh copy of the pipeline in a temporary
+directory, so the URL plan index and the dedup index of earlier runs do
+not carry over, and the site and the items only depend on the seeds.
+Runs with the same options are therefore comparable; use --results to
+collect them in a file, one JSON object per run. Run it from the
+repository root, with seesaw, Wget+Lua and rsync installed:
+
+  python bench/run_pipeline_bench.py --items 200 --concurrent 4 \
+      --rsync-threads 2 --mix wallpaper=8,tag=1,user=1 --results bench.jsonl
+
+To try the bind address pool, bind to loopback aliases and have the
+fake site throttle one of them:
+
+  python bench/run_pipeline_bench.py --bind-addresses 127.0.0.2,127.0.0.3 \
+      --throttled-addresses 127.0.0.3
+
+This harness has not been through a full run yet: it was written on a
+machine without rsync and without a Wget+Lua it could execute. Only its
+parts have been tried, see bench/README.md. Treat the first numbers it
+gives with suspicion.
+'''
+import argparse
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+import fake_tracker
+import fake_wallbase
+
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPELINE_FILES = ['pipeline.py', 'warc_check.py', 'wallbase.lua', 'JSON.lua',
+    'urlcode.lua', 'table_show.lua']
+WGET_LUA_FILES = ['wget-lua', 'wget-lua-warrior', 'wget-lua-local']
+
+RSYNCD_CONF = '''\
+use chroot = false
+[bench]
+path = %s
+read only = false
+'''
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_server(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return '%s:%d' % server.server_address
+
+
+def prepare_workdir(workdir):
+    pipeline_dir = os.path.join(workdir, 'pipeline')
+    os.makedirs(pipeline_dir)
+    for name in PIPELINE_FILES:
+        shutil.copy(os.path.join(REPO, name), pipeline_dir)
+    for name in WGET_LUA_FILES:
+        if os.path.exists(os.path.join(REPO, name)):
+            os.symlink(os.path.join(REPO, name), os.path.join(pipeline_dir, name))
+    return pipeline_dir
+
+
+def start_rsync_daemon(workdir):
+    upload_dir = os.path.join(workdir, 'upload')
+    os.makedirs(upload_dir)
+    conf = os.path.join(workdir, 'rsyncd.conf')
+    with open(conf, 'w') as f:
+        f.write(RSYNCD_CONF % upload_dir)
+
+    port = free_port()
+    process = subprocess.Popen(['rsync', '--daemon', '--no-detach',
+        '--config', conf, '--address', '127.0.0.1', '--port', str(port)])
+    return process, upload_dir, 'rsync://127.0.0.1:%d/bench/' % port
+
+
+def read_metrics(filename):
+    '''
+    Returns [(name, {labels}, value)] from a Prometheus text file.
+    '''
+    metrics = []
+    if not os.path.exists(filename):
+        return metrics
+    with open(filename) as f:
+        for line in f:
+            m = re.match(r'^([a-z_]+)\{(.*)\} (\S+)$', line.strip())
+            if m:
+                labels = dict(re.findall(r'([a-z_]+)="((?:[^"\\]|\\.)*)"', m.group(2)))
+                metrics.append((m.group(1), labels, float(m.group(3))))
+    return metrics
+
+
+def summarize_metrics(metrics):
+    task_seconds = {}
+    task_counts = {}
+    url_bytes = 0
+    urls = 0
+    addresses = {}
+    for name, labels, value in metrics:
+        if name == 'wallbase_task_seconds_sum':
+            task_seconds[labels['task']] = task_seconds.get(labels['task'], 0) + value
+        elif name == 'wallbase_task_seconds_count':
+            task_counts[labels['task']] = task_counts.get(labels['task'], 0) + value
+        elif name == 'wallbase_url_bytes_total':
+            url_bytes += value
+        elif name == 'wallbase_urls_total':
+            urls += value
+        elif name.startswith('wallbase_address_'):
+            addresses.setdefault(labels['address'], {})[
+                re.sub('_total$', '', name[len('wallbase_address_'):])] = int(value)
+    task_mean_seconds = dict((task, task_seconds[task] / task_counts[task])
+        for task in task_seconds if task_counts.get(task))
+    return task_mean_seconds, int(url_bytes), int(urls), addresses
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+        for dirpath, dirnames, filenames in os.walk(path)
+        for filename in filenames)
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='wallbase-bench-')
+    pipeline_dir = prepare_workdir(workdir)
+    rsync_daemon, upload_dir, upload_target = start_rsync_daemon(workdir)
+
+    site = fake_wallbase.site_from_args(args)
+    proxy = start_server(fake_wallbase.Server(('127.0.0.1', 0), site))
+    items = fake_tracker.make_items(args.items,
+        fake_tracker.parse_mix(args.mix), args.seed)
+    tracker = fake_tracker.Tracker(items, upload_target)
+    tracker_host = start_server(fake_tracker.Server(('127.0.0.1', 0), tracker))
+
+    stop_file = os.path.join(workdir, 'STOP')
+    metrics_file = os.path.join(workdir, 'metrics.prom')
+    context = [
+        'tracker_host=' + tracker_host,
+        'http_proxy=' + proxy,
+        'check_ip_hostnames=',
+        'metrics_file=' + metrics_file,
+        'rsync_threads=%d' % args.rsync_threads,
+        'multi_item_size=%d' % args.multi_item_size,
+    ] + args.context
+    if args.bind_addresses:
+        context.append('bind_address=' + args.bind_addresses)
+    command = [args.run_pipeline, 'pipeline.py', 'benchmark',
+        '--disable-web-server', '--concurrent', str(args.concurrent),
+        '--stop-file', stop_file]
+    for value in context:
+        command.extend(['--context-value', value])
+
+    print('Running the pipeline in %s' % workdir)
+    started = time.time()
+    with open(os.path.join(workdir, 'pipeline.log'), 'w') as log:
+        process = subprocess.Popen(command, cwd=pipeline_dir, stdout=log,
+            stderr=subprocess.STDOUT)
+
+        # Once the tracker is out of items and no more are claimed than
+        # the slots hold (the rest wait in the prefetch queue), the
+        # pipeline may stop after the items it is working on.
+        slots = args.concurrent * args.multi_item_size
+        while process.poll() is None:
+            if not tracker.todo and len(tracker.claimed) <= slots and \
+                    not os.path.exists(stop_file):
+                open(stop_file, 'w').close()
+            if time.time() - started > args.timeout:
+                process.terminate()
+            time.sleep(1)
+    elapsed = time.time() - started
+
+    rsync_daemon.terminate()
+
+    task_mean_seconds, url_bytes, urls, addresses = summarize_metrics(read_metrics(metrics_file))
+    result = {
+        'config': {
+            'items': args.items,
+            'mix': args.mix,
+            'seed': args.seed,
+            'concurrent': args.concurrent,
+            'rsync_threads': args.rsync_threads,
+            'multi_item_size': args.multi_item_size,
+            'bind_addresses': args.bind_addresses,
+            'context': args.context,
+            'page_latency': args.page_latency,
+            'image_latency': args.image_latency,
+            'page_size': args.page_size,
+            'image_size': args.image_size,
+            'thumb_404_ratio': args.thumb_404_ratio,
+            'hidden_image_ratio': args.hidden_image_ratio,
+            'gone_page_ratio': args.gone_page_ratio,
+            'max_results': args.max_results,
+            'throttled_addresses': args.throttled_addresses,
+        },
+        'exit_code': process.returncode,
+        'seconds': elapsed,
+        'items_done': len(tracker.done),
+        'items_failed': len(tracker.claimed),
+        'items_per_hour': len(tracker.done) / elapsed * 3600,
+        'uploads': tracker.uploads,
+        'urls': urls,
+        'requests': site.requests,
+        'client_requests': site.client_requests,
+        'status_codes': dict((str(k), v) for k, v in site.status_codes.items()),
+        'bytes_served': site.bytes,
+        'bytes_downloaded': url_bytes,
+        'bytes_uploaded': directory_size(upload_dir),
+        'task_mean_seconds': task_mean_seconds,
+        'addresses': addresses,
+    }
+
+    if args.keep_workdir:
+        print('Kept %s' % workdir)
+    else:
+        shutil.rmtree(workdir)
+
+    return result
+
+
+def print_result(result):
+    print('')
+    print('%-24s %12.1f' % ('items/hour', result['items_per_hour']))
+    print('%-24s %12d' % ('items done', result['items_done']))
+    print('%-24s %12d' % ('items failed', result['items_failed']))
+    print('%-24s %12.1f' % ('seconds', result['seconds']))
+    print('%-24s %12d' % ('urls', result['urls']))
+    print('%-24s %12d' % ('bytes downloaded', result['bytes_downloaded']))
+    print('%-24s %12d' % ('bytes uploaded', result['bytes_uploaded']))
+    print('')
+    print('%-24s %12s' % ('task', 'mean seconds'))
+    for task, seconds in sorted(result['task_mean_seconds'].items()):
+        print('%-24s %12.3f' % (task, seconds))
+
+    if result['addresses']:
+        print('')
+        print('%-24s %12s %12s %12s %12s' % ('address', 'urls', 'bytes',
+            'errors', 'quarantines'))
+        for address, stats in sorted(result['addresses'].items()):
+            print('%-24s %12d %12d %12d %12d' % (address, stats['urls'],
+                stats['bytes'], stats['errors'], stats['quarantines']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--mix', default='wallpaper=8,tag=1,user=1',
+        help='weights of the item types, e.g. wallpaper=8,tag=1')
+    parser.add_argument('--concurrent', type=int, default=2)
+    parser.add_argument('--rsync-threads', type=int, default=1)
+    parser.add_argument('--multi-item-size', type=int, default=1)
+    parser.add_argument('--bind-addresses', default='',
+        help='source addresses for Wget, e.g. 127.0.0.2,127.0.0.3')
+    parser.add_argument('--context', action='append', default=[],
+        metavar='NAME=VALUE', help='more context values for the pipeline')
+    parser.add_argument('--run-pipeline', default='run-pipeline')
+    parser.add_argument('--timeout', type=int, default=3600)
+    parser.add_argument('--results', metavar='FILE',
+        help='append the result to this file as a JSON line')
+    parser.add_argument('--keep-workdir', action='store_true')
+    fake_wallbase.add_arguments(parser)
+    args = parser.parse_args()
+
+    for program in ('rsync', args.run_pipeline):
+        if not which(program):
+            parser.error('%s not found' % program)
+
+    result = run(args)
+    print_result(result)
+
+    if args.results:
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(result, sort_keys=True) + '\n')
+
+    if result['exit_code'] != 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
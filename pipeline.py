@@ -1,18 +1,31 @@
 # encoding=utf8
+import atexit
+import collections
 import datetime
+import errno
+import fcntl
 from distutils.version import StrictVersion
+import functools
+import glob
 import hashlib
+import json
+import math
+import multiprocessing
 import os.path
+import gzip
 import random
 from seesaw.config import realize, NumberConfigValue
 from seesaw.item import ItemInterpolation, ItemValue
-from seesaw.task import SimpleTask, LimitConcurrent
-from seesaw.tracker import GetItemFromTracker, PrepareStatsForTracker, \
-    UploadWithTracker, SendDoneToTracker
+from seesaw.task import Task, SimpleTask, LimitConcurrent
+from seesaw.tracker import PrepareStatsForTracker, UploadWithTracker, \
+    SendDoneToTracker
 import shutil
 import socket
+import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 
 import seesaw
@@ -20,6 +33,12 @@ from seesaw.externalprocess import WgetDownload
 from seesaw.pipeline import Pipeline
 from seesaw.project import Project
 from seesaw.util import find_executable
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop, PeriodicCallback
 
 
 # check the seesaw version
@@ -56,10 +75,88 @@ if not WGET_LUA:
 #
 # Update this each time you make a non-cosmetic change.
 # It will be added to the WARC files and reported to the tracker.
-VERSION = "20140820.01"
+VERSION = "20261017.01"
 USER_AGENT = 'ArchiveTeam'
 TRACKER_ID = 'wallbase'
-TRACKER_HOST = 'tracker.archiveteam.org'
+TRACKER_HOST = globals().get('tracker_host', 'tracker.archiveteam.org')
+
+# Send all of Wget's requests through this HTTP proxy (host:port), e.g.
+# the fake wallbase.cc of bench/run_pipeline_bench.py.
+HTTP_PROXY = globals().get('http_proxy')
+
+# Seconds Wget waits before each request (--wait, with --random-wait).
+# This is all the pacing a Wget+Lua without luasocket gets, see the
+# rate control in wallbase.lua. With luasocket, --context-value
+# wget_wait=0 leaves it to the per-host rate control, which lets the
+# image hosts go at full speed.
+WGET_WAIT = float(globals().get('wget_wait', 0.5))
+
+# Number of items claimed from the tracker at once and downloaded by a
+# single Wget+Lua process into a single WARC. Set it with
+# --context-value multi_item_size=N; 1 disables batching.
+MULTI_ITEM_SIZE = int(globals().get('multi_item_size', 1))
+
+# Finished items are uploaded together once their WARCs add up to
+# BUNDLE_MAX_SIZE bytes or BUNDLE_MAX_ITEMS items, once no other item is
+# on its way, or after waiting BUNDLE_MAX_AGE seconds, see
+# CoalesceUploads.
+BUNDLE_MAX_SIZE = int(globals().get('bundle_max_size', 100 * 1024 * 1024))
+BUNDLE_MAX_ITEMS = int(globals().get('bundle_max_items', 100))
+BUNDLE_MAX_AGE = int(globals().get('bundle_max_age', 15))
+
+# New items are held back while the disk is almost full or too much
+# waits for upload, see AdmissionControl. Set the limits with
+# --context-value min_free_bytes=N and max_backlog_bytes=N.
+ADMISSION_MIN_FREE_BYTES = int(globals().get('min_free_bytes', 5 * 1024 ** 3))
+ADMISSION_MAX_BACKLOG_BYTES = int(globals().get('max_backlog_bytes', 2 * 1024 ** 3))
+ADMISSION_SLOW_INTERVAL = 30
+ADMISSION_MIN_RSYNC_THREADS = 1
+
+# Hostnames that must all resolve to different addresses, or we are
+# probably behind a firewall/proxy. Checked every CHECK_IP_INTERVAL
+# seconds in the background. --context-value check_ip_hostnames=A,B
+# checks other ones; an empty list disables the check.
+if 'check_ip_hostnames' in globals():
+    CHECK_IP_HOSTNAMES = [hostname for hostname
+        in globals()['check_ip_hostnames'].split(',') if hostname]
+else:
+    CHECK_IP_HOSTNAMES = [
+        'twitter.com',
+        'facebook.com',
+        'youtube.com',
+        'microsoft.com',
+        'icanhas.cheezburger.com',
+        'archiveteam.org',
+    ]
+CHECK_IP_INTERVAL = 600
+CHECK_IP_TIMEOUT = 10
+
+# Source addresses for Wget, --context-value bind_address=A,B,... Every
+# try of WgetDownload binds to the least busy one. An address that gets
+# at least ADDRESS_STORM_ERRORS 429/5xx responses in a Wget run, and
+# for at least ADDRESS_STORM_RATIO of its URLs, is avoided for
+# ADDRESS_QUARANTINE_TIME seconds. wallbase.lua gives up after 5 errors
+# in a row, so a run never gets many more than that.
+BIND_ADDRESSES = [address for address
+    in globals().get('bind_address', '').split(',') if address]
+ADDRESS_STORM_ERRORS = 3
+ADDRESS_STORM_RATIO = 0.1
+ADDRESS_QUARANTINE_TIME = 900
+
+# Items are claimed from the tracker ahead of time, see PrefetchQueue.
+# At most PREFETCH_MAX_DEPTH of them (--context-value
+# prefetch_max_depth=N) wait in the queue, none longer than
+# PREFETCH_MAX_AGE seconds, well within the tracker's claim expiry.
+PREFETCH_MIN_DEPTH = 1
+PREFETCH_MAX_DEPTH = int(globals().get('prefetch_max_depth', 4))
+PREFETCH_MAX_AGE = 1800
+PREFETCH_LEAD_TIME = 60
+
+if MULTI_ITEM_SIZE > 1:
+    ITEM_REQUEST_URL = "http://%s/%s/multi=%d/" % (TRACKER_HOST, TRACKER_ID,
+        MULTI_ITEM_SIZE)
+else:
+    ITEM_REQUEST_URL = "http://%s/%s" % (TRACKER_HOST, TRACKER_ID)
 
 
 ###########################################################################
@@ -68,74 +165,1234 @@ TRACKER_HOST = 'tracker.archiveteam.org'
 # Simple tasks (tasks that do not need any concurrency) are based on the
 # SimpleTask class and have a process(item) method that is called for
 # each item.
-class CheckIP(SimpleTask):
-    def __init__(self):
-        SimpleTask.__init__(self, "CheckIP")
-        self._counter = 0
+class NetworkCheck(object):
+    """
+    Checks in the background whether we are behind a firewall/proxy.
 
-    def process(self, item):
+    Every interval seconds the hostnames are resolved concurrently, each
+    in its own thread with the given timeout. The network is fine when
+    all of them resolve to different addresses. A verdict older than
+    twice the interval no longer counts. Callbacks passed to wait() are
+    called on the IOLoop as soon as the running check is done.
+    """
+    def __init__(self, hostnames, interval, timeout):
+        self.hostnames = hostnames
+        self.interval = interval
+        self.timeout = timeout
+        self.addresses = {}
+        self.latencies = {}
+        self.checked = None
+        self.generation = 0
+        self._ok = False
+        self._lock = threading.Lock()
+        self._running = False
+        self._waiting = []
+        self._periodic = None
+
+    def start(self):
+        if self._periodic is None:
+            self._periodic = PeriodicCallback(self.refresh, self.interval * 1000)
+            self._periodic.start()
+            self.refresh()
+
+    def refresh(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+
+        thread = threading.Thread(target=self._check)
+        thread.daemon = True
+        thread.start()
+
+    def wait(self, callback):
+        with self._lock:
+            if self._running:
+                self._waiting.append(callback)
+                return
+        IOLoop.instance().add_callback(callback)
+
+    def stale(self):
+        return self.checked is None or \
+            time.time() - self.checked >= 2 * self.interval
+
+    def ok(self):
+        with self._lock:
+            return self._ok and not self.stale()
+
+    def _check(self):
+        addresses = {}
+        latencies = {}
+
+        def resolve(hostname):
+            start = time.time()
+            try:
+                addresses[hostname] = socket.gethostbyname(hostname)
+            except socket.error:
+                addresses[hostname] = None
+            latencies[hostname] = time.time() - start
+
+        threads = [threading.Thread(target=resolve, args=(hostname,))
+            for hostname in self.hostnames]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        deadline = time.time() + self.timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+
+        # Hostnames that did not resolve in time count as failed.
+        addresses = dict((hostname, addresses.get(hostname))
+            for hostname in self.hostnames)
+        latencies = dict((hostname, latencies.get(hostname, self.timeout))
+            for hostname in self.hostnames)
+        resolved = [address for address in addresses.values() if address]
+
+        with self._lock:
+            self.addresses = addresses
+            self.latencies = latencies
+            self._ok = len(set(resolved)) == len(self.hostnames)
+            self.checked = time.time()
+            self.generation += 1
+            self._running = False
+            waiting = self._waiting
+            self._waiting = []
+
+        for callback in waiting:
+            IOLoop.instance().add_callback(callback)
+
+
+class CheckIP(Task):
+    """
+    Holds items back, before they get one from the tracker, for as long
+    as the network check does not pass.
+    """
+    def __init__(self, network_check, retry_delay=30):
+        Task.__init__(self, "CheckIP")
+        self.network_check = network_check
+        self.retry_delay = retry_delay
+        self._logged_generation = 0
+
+    def enqueue(self, item):
         # NEW for 2014! Check if we are behind firewall/proxy
+        self.start_item(item)
+        self.network_check.start()
+        self._wait_for_network(item)
+
+    def _wait_for_network(self, item):
+        network_check = self.network_check
+
+        if network_check.generation != self._logged_generation:
+            self._logged_generation = network_check.generation
+            item.log_output('Checked IP addresses: {0}'.format(', '.join(
+                '{0}={1} ({2:.0f} ms)'.format(hostname,
+                    network_check.addresses[hostname],
+                    network_check.latencies[hostname] * 1000)
+                for hostname in network_check.hostnames)))
+
+        if network_check.ok():
+            self.complete_item(item)
+            return
+
+        if network_check.stale():
+            # No verdict yet, or an outdated one: carry on as soon as the
+            # check is done.
+            if network_check.checked is None:
+                item.log_output('Checking IP address.')
+            self._check_again(item)
+            return
+
+        item.log_output(
+            'Are you behind a firewall/proxy? That is a big no-no!')
+        item.log_output('Not starting new items, checking again in {0} seconds.'.format(
+            self.retry_delay))
+        IOLoop.instance().add_timeout(
+            datetime.timedelta(seconds=self.retry_delay),
+            functools.partial(self._check_again, item))
+
+    def _check_again(self, item):
+        self.network_check.refresh()
+        self.network_check.wait(functools.partial(self._wait_for_network, item))
+
+
+class PrefetchQueue(object):
+    """
+    Claims items from the tracker ahead of time, so a free slot does not
+    wait for the tracker.
+
+    The queue is refilled in the background, one request at a time and
+    only while the network check passes, intake is not paused and no
+    stop has been requested, up to about as many items as the slots take
+    in lead_time seconds (at least min_depth, at most max_depth). Items
+    older than max_age are dropped and left to the tracker's claim
+    expiry, as the tracker has no way to hand a claim back.
+
+    The remaining ones are saved on exit to a file of their own, named
+    after queue_file, the downloader and the process ID, and used first
+    on the next start of a pipeline of the same downloader. A starting
+    pipeline takes over such a file by renaming it, so two that start at
+    the same time never load the same items.
+    """
+    DEFAULT_RETRY_DELAY = 60
+
+    def __init__(self, tracker_url, downloader, version, network_check,
+                 admission_control, queue_file, min_depth, max_depth,
+                 max_age, lead_time):
+        self.tracker_url = tracker_url
+        self.downloader = downloader
+        self.version = version
+        self.network_check = network_check
+        self.admission_control = admission_control
+        self.queue_file = queue_file
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.max_age = max_age
+        self.lead_time = lead_time
+        self.items = collections.deque()
+        self.waiting = collections.deque()
+        self.retry_delay = self.DEFAULT_RETRY_DELAY
+        self.take_interval = None
+        self._last_take = None
+        self._requesting = False
+        self._retry_at = 0
+        self._periodic = None
+        self._stopping = False
+
+    def start(self, pipeline):
+        if self._periodic is None:
+            pipeline.on_stop_requested += self._stop_requested
+            pipeline.on_stop_canceled += self._stop_canceled
+            self.load()
+            atexit.register(self.save)
+            self._periodic = PeriodicCallback(self.refill, 1000)
+            self._periodic.start()
+            self.refill()
+
+    def _stop_requested(self):
+        self._stopping = True
+
+    def _stop_canceled(self):
+        self._stopping = False
 
-        if self._counter <= 0:
-            item.log_output('Checking IP address.')
-            ip_set = set()
-
-            ip_set.add(socket.gethostbyname('twitter.com'))
-            ip_set.add(socket.gethostbyname('facebook.com'))
-            ip_set.add(socket.gethostbyname('youtube.com'))
-            ip_set.add(socket.gethostbyname('microsoft.com'))
-            ip_set.add(socket.gethostbyname('icanhas.cheezburger.com'))
-            ip_set.add(socket.gethostbyname('archiveteam.org'))
-
-            if len(ip_set) != 6:
-                item.log_output('Got IP addresses: {0}'.format(ip_set))
-                item.log_output(
-                    'Are you behind a firewall/proxy? That is a big no-no!')
-                raise Exception(
-                    'Are you behind a firewall/proxy? That is a big no-no!')
-
-        # Check only occasionally
-        if self._counter <= 0:
-            self._counter = 10
+    def _queue_file_pattern(self):
+        base, extension = os.path.splitext(self.queue_file)
+        return "%s-%s-%%s%s" % (base, realize(self.downloader), extension)
+
+    def load(self):
+        pattern = self._queue_file_pattern()
+        own_file = pattern % os.getpid()
+        for filename in glob.glob(pattern % "*"):
+            loading_file = own_file + ".loading"
+            try:
+                os.rename(filename, loading_file)
+            except OSError:
+                # Another pipeline took it over first.
+                continue
+            with open(loading_file) as f:
+                for claimed, data in json.load(f):
+                    if time.time() - claimed < self.max_age:
+                        self.items.append((claimed, data))
+            os.remove(loading_file)
+
+    def save(self):
+        if self.items:
+            with open(self._queue_file_pattern() % os.getpid(), 'w') as f:
+                json.dump(list(self.items), f)
+
+    def depth(self):
+        if self.take_interval is None:
+            return self.min_depth
+        depth = int(math.ceil(self.lead_time / self.take_interval))
+        return max(self.min_depth, min(self.max_depth, depth))
+
+    def get(self, item, callback):
+        """Calls callback(item, data) with the next claimed item."""
+        now = time.time()
+        if self._last_take is not None:
+            interval = now - self._last_take
+            if self.take_interval is None:
+                self.take_interval = interval
+            else:
+                self.take_interval = 0.8 * self.take_interval + 0.2 * interval
+        self._last_take = now
+
+        self.waiting.append((item, callback))
+        self._serve()
+        self.refill()
+
+    def _drop_canceled(self):
+        self.waiting = collections.deque((item, callback)
+            for item, callback in self.waiting if not item.canceled)
+
+    def _serve(self):
+        self._drop_canceled()
+        while self.items and self.waiting:
+            item, callback = self.waiting.popleft()
+            claimed, data = self.items.popleft()
+            callback(item, data)
+
+    def refill(self):
+        while self.items and time.time() - self.items[0][0] >= self.max_age:
+            self.items.popleft()
+        self._drop_canceled()
+
+        if self._requesting or self._stopping or time.time() < self._retry_at or \
+                not self.network_check.ok() or \
+                self.admission_control.intake == "paused" or \
+                len(self.items) >= self.depth() + len(self.waiting):
+            return
+
+        self._requesting = True
+        data = {
+            "downloader": realize(self.downloader),
+            "api_version": "2",
+            "version": realize(self.version),
+        }
+        AsyncHTTPClient().fetch(
+            HTTPRequest(
+                "%s/request" % self.tracker_url,
+                method="POST",
+                headers={"Content-Type": "application/json"},
+                user_agent=("ArchiveTeam Warrior/%s %s %s" % (
+                    seesaw.__version__, seesaw.runner_type,
+                    seesaw.warrior_build)).strip(),
+                body=json.dumps(data)
+            ),
+            self._handle_response)
+
+    def _handle_response(self, response):
+        self._requesting = False
+
+        data = None
+        if response.code == 200:
+            data = json.loads(response.body.decode('utf-8'))
+        if data and "item_name" in data:
+            self.retry_delay = self.DEFAULT_RETRY_DELAY
+            self.items.append((time.time(), data))
+            self._serve()
+            self.refill()
+            return
+
+        message = "Tracker returned status code %d while prefetching. " % response.code
+        self._drop_canceled()
+        for item, callback in self.waiting:
+            item.log_output("%sRetrying after %d seconds...\n" % (
+                message, self.retry_delay))
+        self._retry_at = time.time() + self.retry_delay
+        self.retry_delay = min(300, self.retry_delay + 10)
+
+
+class GetPrefetchedItem(Task):
+    """
+    Takes the next item of a PrefetchQueue, instead of asking the
+    tracker with GetItemFromTracker.
+    """
+    def __init__(self, prefetch_queue):
+        Task.__init__(self, "GetItemFromTracker")
+        self.prefetch_queue = prefetch_queue
+
+    def enqueue(self, item):
+        self.start_item(item)
+        item.may_be_canceled = True
+        self.prefetch_queue.start(item.pipeline)
+        self.prefetch_queue.get(item, self._received)
+
+    def _received(self, item, data):
+        item.may_be_canceled = False
+        for (k, v) in data.items():
+            item[k] = v
+        item.log_output("Received item '%s' from tracker\n" % item["item_name"])
+        self.complete_item(item)
+
+
+class AddressPool(object):
+    """
+    The source addresses Wget can bind to.
+
+    acquire() hands out the address with the fewest running Wget
+    processes, and of those the one throttled longest ago. An address
+    whose Wget run got storm_errors or more 429/5xx (or failed
+    connection) responses, and at least storm_ratio of its URLs, is
+    quarantined for quarantine_time seconds and only used when all of
+    them are.
+    """
+    def __init__(self, addresses, storm_errors, storm_ratio, quarantine_time):
+        self.addresses = addresses
+        self.storm_errors = storm_errors
+        self.storm_ratio = storm_ratio
+        self.quarantine_time = quarantine_time
+        self.stats = dict((address, {
+            'active': 0,
+            'runs': 0,
+            'urls': 0,
+            'bytes': 0,
+            'errors': 0,
+            'throttled': 0,
+            'quarantines': 0,
+            'last_throttled': 0,
+            'quarantined_until': 0,
+        }) for address in addresses)
+
+    def quarantined(self, address):
+        return self.stats[address]['quarantined_until'] > time.time()
+
+    def available(self):
+        return not self.addresses or any(not self.quarantined(address)
+            for address in self.addresses)
+
+    def acquire(self):
+        if not self.addresses:
+            return None
+        address = min(self.addresses, key=lambda address: (
+            self.quarantined(address) and self.stats[address]['quarantined_until'],
+            self.stats[address]['active'],
+            self.stats[address]['last_throttled']))
+        self.stats[address]['active'] += 1
+        self.stats[address]['runs'] += 1
+        return address
+
+    def release(self, address, url_metrics):
+        """
+        Returns the address and counts the url_metrics of the Wget runs
+        that used it, see CollectUrlMetrics. Returns True if the address
+        was quarantined.
+        """
+        stats = self.stats[address]
+        stats['active'] -= 1
+
+        urls = 0
+        errors = 0
+        throttled = 0
+        for data in url_metrics:
+            urls += data['urls']
+            stats['urls'] += data['urls']
+            stats['bytes'] += data['bytes']
+            for status_code, count in data['status_codes'].items():
+                if status_code == '429':
+                    throttled += count
+                if status_code in ('0', '429') or int(status_code) >= 500:
+                    errors += count
+        stats['errors'] += errors
+        stats['throttled'] += throttled
+
+        if errors > 0:
+            stats['last_throttled'] = time.time()
+        if errors >= self.storm_errors and errors >= self.storm_ratio * urls:
+            stats['quarantines'] += 1
+            stats['quarantined_until'] = time.time() + self.quarantine_time
+            return True
+        return False
+
+
+class BindAddress(Task):
+    """
+    Runs inner_task (WgetDownload) with an address of the pool.
+
+    Items are held back while every address is quarantined. WgetArgs
+    takes an address for each try and gives back the one of the
+    previous try; the last one is given back here.
+    """
+    def __init__(self, inner_task, address_pool, retry_delay=30):
+        Task.__init__(self, "BindAddress")
+        self.inner_task = inner_task
+        self.inner_task.on_complete_item += self._inner_task_complete_item
+        self.inner_task.on_fail_item += self._inner_task_fail_item
+        self.address_pool = address_pool
+        self.retry_delay = retry_delay
+
+    def enqueue(self, item):
+        if self.address_pool.available():
+            self._enqueue_inner_task_with_except(self.inner_task, item)
+            return
+
+        item.log_output('All bind addresses are quarantined, checking again in {0} seconds.'.format(
+            self.retry_delay))
+        IOLoop.instance().add_timeout(
+            datetime.timedelta(seconds=self.retry_delay),
+            functools.partial(self.enqueue, item))
+
+    def _inner_task_complete_item(self, task, item):
+        release_address(item)
+        self.complete_item(item)
+
+    def _inner_task_fail_item(self, task, item):
+        release_address(item)
+        self.fail_item(item)
+
+    def fill_ui_task_list(self, task_list):
+        self.inner_task.fill_ui_task_list(task_list)
+
+    def __str__(self):
+        return str(self.inner_task)
+
+
+class WorkdirPool(object):
+    """
+    Working directories for items, created ahead of time by a background
+    thread that also deletes the used ones, so neither happens on an
+    item's path.
+
+    The directories live in base_dir/wallbase-workdirs/<pid>; the ones
+    of pipelines that no longer run are deleted on start, nothing else
+    in base_dir is touched. With a scratch_dir (e.g. on a tmpfs) every
+    item also gets a directory there, in the same layout, for Wget's
+    throwaway --output-document.
+    """
+    POOL_DIR_NAME = 'wallbase-workdirs'
+
+    def __init__(self, base_dir, size, scratch_dir=None):
+        self.base_dir = base_dir
+        self.size = size
+        self.scratch_dir = scratch_dir
+        self.pool_dirs = [os.path.join(dirname, self.POOL_DIR_NAME, str(os.getpid()))
+            for dirname in (base_dir, scratch_dir) if dirname]
+        self._free = collections.deque()
+        self._jobs = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        for pool_dir in self.pool_dirs:
+            parent_dir = os.path.dirname(pool_dir)
+            if os.path.isdir(parent_dir):
+                for name in os.listdir(parent_dir):
+                    if name.isdigit() and not pid_running(int(name)):
+                        self._remove(os.path.join(parent_dir, name))
+            if not os.path.isdir(pool_dir):
+                os.makedirs(pool_dir)
+        atexit.register(self._remove_pool_dirs)
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        self._jobs.put(self._fill)
+
+    def acquire(self):
+        """Returns an item directory and a scratch directory (or None)."""
+        self.start()
+        try:
+            dirs = self._free.popleft()
+        except IndexError:
+            dirs = self._create()
+        self._jobs.put(self._fill)
+        return dirs
+
+    def release(self, item):
+        """Deletes the directories of an item in the background."""
+        if 'workdir' not in item:
+            return
+        for dirname in item['workdir']:
+            if dirname:
+                self._remove(dirname)
+        del item['workdir']
+
+    def _create(self):
+        item_dir = tempfile.mkdtemp(prefix='item-', dir=self.pool_dirs[0])
+        scratch_dir = None
+        if self.scratch_dir:
+            scratch_dir = tempfile.mkdtemp(prefix='item-', dir=self.pool_dirs[1])
+        return item_dir, scratch_dir
+
+    def _fill(self):
+        while len(self._free) < self.size:
+            self._free.append(self._create())
+
+    def _remove(self, dirname):
+        self._jobs.put(functools.partial(shutil.rmtree, dirname, True))
+
+    def _remove_pool_dirs(self):
+        for pool_dir in self.pool_dirs:
+            shutil.rmtree(pool_dir, True)
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                job()
+            except Exception as e:
+                print('WorkdirPool: {0}'.format(e))
+
+
+class AdmissionControl(object):
+    """
+    Decides how fast new items may start and how many uploads may run,
+    from the free space on the filesystems we write to, the size of the
+    WARCs of the items in the pipeline that wait for their upload (as
+    recorded by MoveFiles) and the measured upload rate.
+
+    Every interval seconds:
+
+    * intake is paused while a filesystem has less than min_free_bytes
+      free or the backlog is max_backlog_bytes or more, and slowed down
+      to one item every slow_interval seconds from half that backlog on,
+    * the number of uploads starts at max_rsync_threads (the Rsync
+      threads setting, followed when it changes) and, while the backlog
+      grows, moves by one between min_rsync_threads and that setting,
+      climbing towards the highest upload rate: each number is kept for
+      at least probe_time seconds, and the rate uploaded meanwhile is
+      compared with that of the number before. It steps back if one
+      more upload did not raise the rate by min_gain (e.g. 10%) or one
+      fewer lowered it by that much, and then stays for hold_time
+      seconds; otherwise it carries on in the same direction, turning
+      around at the bounds.
+
+    Every change is printed and appended to log_file as a JSON line,
+    together with the measurements it was based on.
+    """
+    def __init__(self, paths, min_free_bytes, max_backlog_bytes,
+                 slow_interval, min_rsync_threads, max_rsync_threads,
+                 log_file, interval=10, probe_time=60, min_gain=0.1,
+                 hold_time=600):
+        self.paths = paths
+        self.min_free_bytes = min_free_bytes
+        self.max_backlog_bytes = max_backlog_bytes
+        self.slow_interval = slow_interval
+        self.min_rsync_threads = min_rsync_threads
+        self.max_rsync_threads = max_rsync_threads
+        self.log_file = log_file
+        self.interval = interval
+        self.probe_time = probe_time
+        self.min_gain = min_gain
+        self.hold_time = hold_time
+        self.intake = "open"
+        self._configured = int(realize(max_rsync_threads))
+        self.rsync_threads = max(min_rsync_threads, self._configured)
+        self.free_bytes = None
+        self.backlog_bytes = 0
+        self.upload_rate = 0.0
+        self._uploaded_bytes = 0
+        self._last_update = None
+        self._last_admit = 0
+        self._pipeline = None
+        self._periodic = None
+        self._direction = -1
+        self._rate_before_change = None
+        self._last_change = 0
+        self._bytes_since_change = 0
+        self._next_probe = 0
+
+    def start(self, pipeline):
+        if self._periodic is None:
+            self._pipeline = pipeline
+            self._last_change = time.time()
+            self._bytes_since_change = 0
+            self._next_probe = self._last_change + self.probe_time
+            self._periodic = PeriodicCallback(self.update, self.interval * 1000)
+            self._periodic.start()
+            self.update()
+
+    def admit(self):
+        """Whether a new item may start now."""
+        if self.intake == "paused":
+            return False
+        if self.intake == "slow" and \
+                time.time() - self._last_admit < self.slow_interval:
+            return False
+        self._last_admit = time.time()
+        return True
+
+    def record_upload(self, size):
+        self._uploaded_bytes += size
+        self._bytes_since_change += size
+
+    def update(self):
+        now = time.time()
+        if self._last_update is not None:
+            rate = self._uploaded_bytes / max(1.0, now - self._last_update)
+            self.upload_rate = 0.7 * self.upload_rate + 0.3 * rate
+        self._uploaded_bytes = 0
+        self._last_update = now
+
+        self.free_bytes = min(disk_free_bytes(path) for path in self.paths)
+        last_backlog_bytes = self.backlog_bytes
+        self.backlog_bytes = sum(item.get("upload_bytes", 0)
+            for item in self._pipeline.items_in_pipeline)
+
+        if self.free_bytes < self.min_free_bytes:
+            self._set_intake("paused", "only {0} bytes free".format(self.free_bytes))
+        elif self.backlog_bytes >= self.max_backlog_bytes:
+            self._set_intake("paused", "{0} bytes waiting for upload".format(self.backlog_bytes))
+        elif self.backlog_bytes >= self.max_backlog_bytes // 2:
+            self._set_intake("slow", "{0} bytes waiting for upload".format(self.backlog_bytes))
         else:
-            self._counter -= 1
+            self._set_intake("open", "{0} bytes waiting for upload".format(self.backlog_bytes))
+
+        self._update_rsync_threads(now, self.backlog_bytes > last_backlog_bytes)
+
+    def _update_rsync_threads(self, now, backlog_growing):
+        configured = int(realize(self.max_rsync_threads))
+        if configured != self._configured:
+            self._configured = configured
+            self._rate_before_change = None
+            self._set_rsync_threads(now, max(self.min_rsync_threads, configured),
+                "the Rsync threads setting is {0}".format(configured))
+            return
+
+        if now < self._next_probe:
+            return
+        rate = self._bytes_since_change / (now - self._last_change)
+
+        if self._rate_before_change is not None:
+            rate_before_change = self._rate_before_change
+            self._rate_before_change = None
+            if self._direction > 0:
+                step_back = rate < rate_before_change * (1 + self.min_gain)
+            else:
+                step_back = rate < rate_before_change * (1 - self.min_gain)
+            if step_back:
+                self._direction = -self._direction
+                self._set_rsync_threads(now, self.rsync_threads + self._direction,
+                    "uploaded {0:.0f} bytes/s, {1:.0f} with {2} uploads".format(
+                    rate, rate_before_change, self.rsync_threads + self._direction))
+                self._next_probe = now + self.hold_time
+                return
+
+        if not backlog_growing or rate == 0:
+            return
+        rsync_threads = self.rsync_threads + self._direction
+        if not self.min_rsync_threads <= rsync_threads <= configured:
+            self._direction = -self._direction
+            rsync_threads = self.rsync_threads + self._direction
+        if self.min_rsync_threads <= rsync_threads <= configured:
+            self._rate_before_change = rate
+            self._set_rsync_threads(now, rsync_threads, "{0} bytes waiting for upload, "
+                "uploaded {1:.0f} bytes/s with {2} uploads".format(
+                self.backlog_bytes, rate, self.rsync_threads))
+
+    def _set_rsync_threads(self, now, rsync_threads, reason):
+        self._last_change = now
+        self._bytes_since_change = 0
+        self._next_probe = now + self.probe_time
+        if rsync_threads != self.rsync_threads:
+            self.rsync_threads = rsync_threads
+            self._log("rsync_threads", rsync_threads, reason)
+
+    def _set_intake(self, intake, reason):
+        if intake != self.intake:
+            self.intake = intake
+            self._log("intake", intake, reason)
+
+    def _log(self, setting, value, reason):
+        print('AdmissionControl: {0} = {1} ({2})'.format(setting, value, reason))
+        with open(self.log_file, "a") as f:
+            f.write(json.dumps({
+                "time": time.time(),
+                "setting": setting,
+                "value": value,
+                "reason": reason,
+                "free_bytes": self.free_bytes,
+                "backlog_bytes": self.backlog_bytes,
+                "upload_rate": self.upload_rate,
+                "intake": self.intake,
+                "rsync_threads": self.rsync_threads,
+            }) + "\n")
+
+
+class UploadConcurrency(object):
+    """The number of concurrent uploads AdmissionControl allows."""
+    def __init__(self, admission_control):
+        self.admission_control = admission_control
+
+    def realize(self, item):
+        return self.admission_control.rsync_threads
+
+    def __str__(self):
+        return str(self.admission_control.rsync_threads)
+
+
+class AdmitItem(Task):
+    """
+    Holds items back, before they get one from the tracker, for as long
+    as AdmissionControl does not admit them.
+    """
+    def __init__(self, admission_control, retry_delay=10):
+        Task.__init__(self, "AdmitItem")
+        self.admission_control = admission_control
+        self.retry_delay = retry_delay
+
+    def enqueue(self, item):
+        self.start_item(item)
+        self.admission_control.start(item.pipeline)
+        self._wait_for_admission(item, False)
+
+    def _wait_for_admission(self, item, logged):
+        if self.admission_control.admit():
+            self.complete_item(item)
+            return
+
+        if not logged:
+            item.log_output('Not starting new items while intake is {0}.'.format(
+                self.admission_control.intake))
+        IOLoop.instance().add_timeout(
+            datetime.timedelta(seconds=self.retry_delay),
+            functools.partial(self._wait_for_admission, item, True))
+
+
+class MeasureUpload(Task):
+    """
+    Runs inner_task (the upload) and tells AdmissionControl how many
+    bytes it uploaded.
+    """
+    def __init__(self, inner_task, admission_control):
+        Task.__init__(self, "MeasureUpload")
+        self.inner_task = inner_task
+        self.inner_task.on_complete_item += self._inner_task_complete_item
+        self.inner_task.on_fail_item += self._inner_task_fail_item
+        self.admission_control = admission_control
+
+    def enqueue(self, item):
+        self._enqueue_inner_task_with_except(self.inner_task, item)
+
+    def _inner_task_complete_item(self, task, item):
+        self.admission_control.record_upload(
+            os.path.getsize(item["upload_file"]) +
+            os.path.getsize(item["upload_index_file"]))
+        self.complete_item(item)
+
+    def _inner_task_fail_item(self, task, item):
+        self.fail_item(item)
+
+    def fill_ui_task_list(self, task_list):
+        self.inner_task.fill_ui_task_list(task_list)
+
+    def __str__(self):
+        return str(self.inner_task)
 
 
 class PrepareDirectories(SimpleTask):
-    def __init__(self, warc_prefix):
+    def __init__(self, warc_prefix, workdir_pool):
         SimpleTask.__init__(self, "PrepareDirectories")
         self.warc_prefix = warc_prefix
+        self.workdir_pool = workdir_pool
 
     def process(self, item):
         item_name = item["item_name"]
-        escaped_item_name = item_name.replace(':', '_').replace('/', '_')
-        dirname = "/".join((item["data_dir"], escaped_item_name))
-
-        if os.path.isdir(dirname):
-            shutil.rmtree(dirname)
+        if '\0' in item_name:
+            # A batch of items; the joined names are too long for a path.
+            escaped_item_name = 'multi-' + hashlib.sha1(
+                item_name.encode('utf8')).hexdigest()
+        else:
+            escaped_item_name = item_name.replace(':', '_').replace('/', '_')
 
-        os.makedirs(dirname)
+        # MoveFiles gives the directories back, or the pool gets them
+        # when the item fails.
+        item_dir, scratch_dir = self.workdir_pool.acquire()
+        item["workdir"] = [item_dir, scratch_dir]
+        item.on_finish += self.workdir_pool.release
 
-        item["item_dir"] = dirname
+        item["item_dir"] = item_dir
+        item["scratch_dir"] = scratch_dir or item_dir
         item["warc_file_base"] = "%s-%s-%s" % (self.warc_prefix, escaped_item_name,
             time.strftime("%Y%m%d-%H%M%S"))
 
         open("%(item_dir)s/%(warc_file_base)s.warc.gz" % item, "w").close()
 
 
-class MoveFiles(SimpleTask):
+class DropFailedItems(SimpleTask):
+    """
+    Removes the items of a batch that the Lua script gave up on.
+
+    They are not reported as done, so the tracker hands them out again
+    once their claim expires. The rest of the batch is kept.
+    """
+    def __init__(self):
+        SimpleTask.__init__(self, "DropFailedItems")
+
+    def process(self, item):
+        failed_file = "%(item_dir)s/failed_items.txt" % item
+        if not os.path.exists(failed_file):
+            return
+
+        with open(failed_file) as f:
+            failed = set(line.strip() for line in f if line.strip())
+
+        item_names = item["item_name"].split('\0')
+        done_names = [name for name in item_names if name not in failed]
+
+        for name in item_names:
+            if name in failed:
+                item.log_output('Item {0} failed, leaving it for the tracker to requeue.'.format(name))
+
+        if not done_names:
+            raise Exception('All items in the batch failed.')
+
+        item["item_name"] = '\0'.join(done_names)
+
+
+class WriteDedupFile(SimpleTask):
+    """
+    Writes the records of the dedup index to a CDX file for wget's
+    --warc-dedup, so payloads archived before are stored as revisit
+    records.
+    """
+    def __init__(self, dedup_index):
+        SimpleTask.__init__(self, "WriteDedupFile")
+        self.dedup_index = dedup_index
+
+    def process(self, item):
+        item["dedup_records"] = self.dedup_index.write_cdx(
+            "%(item_dir)s/dedup.cdx" % item)
+
+
+class ReadDedupRecords(SimpleTask):
+    """
+    Reads the responses wget listed in the CDX files of the item's WARC
+    segments, and the revisit records it wrote instead of duplicates,
+    for UpdateDedupIndex. The index itself is left alone until the item
+    has been uploaded: a payload that never made it to the archive must
+    not turn into revisit records in later items.
+    """
+    def __init__(self, dedup_index):
+        SimpleTask.__init__(self, "ReadDedupRecords")
+        self.dedup_index = dedup_index
+
+    def process(self, item):
+        records = []
+        revisits = []
+
+        for warc_file in sorted(glob.glob("%(item_dir)s/%(warc_file_base)s-*.warc.gz" % item)):
+            cdx_file = warc_file[:-len(".warc.gz")] + ".cdx"
+            if os.path.exists(cdx_file):
+                records.extend(read_cdx_records(cdx_file, os.path.getsize(warc_file)))
+
+            for headers in read_warc_headers(warc_file):
+                if headers.get("WARC-Type") == "revisit":
+                    revisits.append(headers.get("WARC-Refers-To", ""))
+
+        bytes_saved = self.dedup_index.revisited_size(revisits)
+
+        item["dedup_new_records"] = records
+        item["dedup_revisits"] = revisits
+        item["dedup_responses"] = len(records)
+        item["dedup_hits"] = len(revisits)
+        item["dedup_bytes_saved"] = bytes_saved
+
+        if revisits:
+            item.log_output('Wrote {0} revisit records, saving {1} bytes.'.format(
+                len(revisits), bytes_saved))
+
+
+class UpdateDedupIndex(SimpleTask):
+    """
+    Adds the records ReadDedupRecords found to the dedup index, once the
+    item has been uploaded.
+    """
+    def __init__(self, dedup_index):
+        SimpleTask.__init__(self, "UpdateDedupIndex")
+        self.dedup_index = dedup_index
+
+    def process(self, item):
+        self.dedup_index.update(item["dedup_new_records"], item["dedup_revisits"])
+        del item["dedup_new_records"]
+        del item["dedup_revisits"]
+
+
+class TimedTask(Task):
+    """
+    Runs inner_task and records how long each item spent in it in
+    METRICS, by item type.
+    """
+    def __init__(self, inner_task, name=None):
+        Task.__init__(self, "Timed")
+        self.inner_task = inner_task
+        self.inner_task.on_complete_item += self._inner_task_complete_item
+        self.inner_task.on_fail_item += self._inner_task_fail_item
+        self.timed_name = name or inner_task.name
+        self._started = {}
+
+    def enqueue(self, item):
+        self._started[item] = time.time()
+        self._enqueue_inner_task_with_except(self.inner_task, item)
+
+    def _observe(self, item, result):
+        started = self._started.pop(item, None)
+        if started is not None:
+            METRICS.observe_task(self.timed_name, get_item_type(item), result,
+                time.time() - started)
+
+    def _inner_task_complete_item(self, task, item):
+        self._observe(item, "completed")
+        self.complete_item(item)
+
+    def _inner_task_fail_item(self, task, item):
+        self._observe(item, "failed")
+        self.fail_item(item)
+
+    def fill_ui_task_list(self, task_list):
+        self.inner_task.fill_ui_task_list(task_list)
+
+    def __str__(self):
+        return str(self.inner_task)
+
+
+class CollectUrlMetrics(SimpleTask):
+    """
+    Adds the per-URL counts, bytes, status codes and latencies that
+    wallbase.lua wrote for each wget run of the item to METRICS.
+    """
+    def __init__(self):
+        SimpleTask.__init__(self, "CollectUrlMetrics")
+
+    def process(self, item):
+        for data in read_url_metrics(item):
+            METRICS.add_url_metrics(get_item_type(item), data)
+
+
+class UpdateUrlPlanIndex(SimpleTask):
+    """
+    Adds the image URL hit counts that wallbase.lua wrote for each wget
+    run of the item to the URL plan index.
+    """
+    def __init__(self, index_file):
+        SimpleTask.__init__(self, "UpdateUrlPlanIndex")
+        self.index_file = index_file
+
+    def process(self, item):
+        deltas_file = "%(item_dir)s/url_plan_deltas.jsonl" % item
+        if not os.path.exists(deltas_file):
+            return
+        with open(deltas_file) as f:
+            deltas = [json.loads(line) for line in f if line.strip()]
+        update_url_plan_index(self.index_file, deltas)
+
+
+class MergeWarcSegments(SimpleTask):
+    """
+    Concatenates the WARC segments written by the tries of WgetDownload
+    into the item's WARC file. Every WARC record is its own gzip member,
+    so the result is a valid .warc.gz.
+    """
     def __init__(self):
+        SimpleTask.__init__(self, "MergeWarcSegments")
+
+    def process(self, item):
+        segments = sorted(glob.glob("%(item_dir)s/%(warc_file_base)s-*.warc.gz" % item))
+
+        with open("%(item_dir)s/%(warc_file_base)s.warc.gz" % item, "wb") as out_file:
+            for segment in segments:
+                with open(segment, "rb") as in_file:
+                    shutil.copyfileobj(in_file, out_file)
+
+        if len(segments) > 1:
+            item.log_output('Merged {0} WARC segments.'.format(len(segments)))
+
+        for segment in segments:
+            os.remove(segment)
+
+
+class CheckWarc(Task):
+    """
+    Checks the gzip members and WARC records of the item's WARC and
+    writes a CDXJ index of it, in a process pool so that the other items
+    carry on meanwhile. A broken WARC fails the item instead of being
+    uploaded. The record counts by type, status code and MIME type go to
+    the tracker with the other stats.
+
+    The pool of processes is only started by the first check. An item
+    whose check has not finished after timeout seconds (a hung or killed
+    pool process never calls back) fails; a late result is ignored.
+    """
+    def __init__(self, processes, timeout):
+        Task.__init__(self, "CheckWarc")
+        self.processes = processes
+        self.timeout = timeout
+        self._pool = None
+        self._pending = {}
+
+    def enqueue(self, item):
+        self.start_item(item)
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes)
+        self._pending[id(item)] = IOLoop.instance().add_timeout(
+            datetime.timedelta(seconds=self.timeout),
+            functools.partial(self._timed_out, item))
+
+        kwargs = {"callback": functools.partial(self._checked_in_thread, item)}
+        if sys.version_info[0] >= 3:
+            kwargs["error_callback"] = functools.partial(self._failed_in_thread, item)
+        self._pool.apply_async(warc_check.check_warc_in_pool, (
+            "%(item_dir)s/%(warc_file_base)s.warc.gz" % item,
+            "%(item_dir)s/%(warc_file_base)s.cdxj" % item,
+        ), **kwargs)
+
+    def _checked_in_thread(self, item, result):
+        # Called in a thread of the pool.
+        IOLoop.instance().add_callback(functools.partial(self._checked, item, result))
+
+    def _failed_in_thread(self, item, error):
+        # Called in a thread of the pool.
+        self._checked_in_thread(item, {"error": "Could not check the WARC: %r" % (error,)})
+
+    def _timed_out(self, item):
+        if self._pending.pop(id(item), None) is None:
+            return
+        item.log_output('Checking the WARC took more than {0} seconds.'.format(
+            self.timeout))
+        self.fail_item(item)
+
+    def _checked(self, item, result):
+        timeout = self._pending.pop(id(item), None)
+        if timeout is None:
+            return
+        IOLoop.instance().remove_timeout(timeout)
+
+        if "error" in result:
+            item.log_output('The WARC is broken: {0}'.format(result["error"]))
+            self.fail_item(item)
+            return
+
+        item["warc_check"] = result
+        item.log_output('Checked {0} WARC records in {1} gzip members.'.format(
+            result["records"], result["members"]))
+        self.complete_item(item)
+
+
+class MoveFiles(SimpleTask):
+    def __init__(self, workdir_pool):
         SimpleTask.__init__(self, "MoveFiles")
+        self.workdir_pool = workdir_pool
 
     def process(self, item):
         # NEW for 2014! Check if wget was compiled with zlib support
-        if os.path.exists("%(item_dir)s/%(warc_file_base)s.warc"):
+        if glob.glob("%(item_dir)s/%(warc_file_base)s-*.warc" % item):
             raise Exception('Please compile wget with zlib support!')
 
-        os.rename("%(item_dir)s/%(warc_file_base)s.warc.gz" % item,
-              "%(data_dir)s/%(warc_file_base)s.warc.gz" % item)
+        for extension in (".warc.gz", ".cdxj"):
+            if move_file("%(item_dir)s/%(warc_file_base)s" % item + extension,
+                    "%(data_dir)s/%(warc_file_base)s" % item + extension):
+                item.log_output('Copied {0} to the data directory, which is on '
+                    'another filesystem than {1}.'.format(extension,
+                    self.workdir_pool.base_dir))
+
+        # Waits for upload until CoalesceUploads is done with the item,
+        # see AdmissionControl.
+        item["upload_bytes"] = os.path.getsize(
+            "%(data_dir)s/%(warc_file_base)s.warc.gz" % item)
 
-        shutil.rmtree("%(item_dir)s" % item)
+        self.workdir_pool.release(item)
+
+
+class CoalesceUploads(Task):
+    """
+    Packs the WARCs of finished items into bundles, so a single upload
+    carries many small items.
+
+    Items wait here until the bundle reaches max_size bytes or max_items
+    items, until every other item in the pipeline that has been claimed
+    from the tracker is waiting here or uploading (a waiting item holds
+    its slot, so nothing else would join), or until the oldest has
+    waited max_age seconds. The bundle is then written next to the first
+    item's WARC and that item alone goes through inner_task with it. All
+    items of the bundle complete (or fail) together once the upload has,
+    so none of them is reported done before its data is uploaded.
+    """
+    def __init__(self, inner_task, max_size, max_age, max_items):
+        Task.__init__(self, "CoalesceUploads")
+        self.inner_task = inner_task
+        self.inner_task.on_complete_item += self._inner_task_complete_item
+        self.inner_task.on_fail_item += self._inner_task_fail_item
+        self.max_size = max_size
+        self.max_age = max_age
+        self.max_items = max_items
+        self._pending = []
+        self._pending_size = 0
+        self._timeout = None
+        self._bundles = {}
+
+    def enqueue(self, item):
+        self.start_item(item)
+        item["upload_file"] = "%(data_dir)s/%(warc_file_base)s.warc.gz" % item
+        item["upload_index_file"] = "%(data_dir)s/%(warc_file_base)s.cdxj" % item
+        self._pending.append(item)
+        self._pending_size += os.path.getsize(item["upload_file"])
+
+        if self._pending_size >= self.max_size or \
+                len(self._pending) >= self.max_items or \
+                not self._items_on_their_way(item.pipeline):
+            self._flush()
+        elif self._timeout is None:
+            item.log_output('Waiting up to {0} seconds to upload along with other items.'.format(self.max_age))
+            self._timeout = IOLoop.instance().add_timeout(
+                datetime.timedelta(seconds=self.max_age), self._flush)
+
+    def _items_on_their_way(self, pipeline):
+        # Items that got here have an upload_file, the ones that have not
+        # been claimed yet have no item_name.
+        return any("item_name" in item and "upload_file" not in item
+            for item in pipeline.items_in_pipeline)
+
+    def _flush(self):
+        if self._timeout is not None:
+            IOLoop.instance().remove_timeout(self._timeout)
+            self._timeout = None
+
+        items = self._pending
+        self._pending = []
+        self._pending_size = 0
+
+        if not items:
+            return
+
+        carrier = items[0]
+        try:
+            if len(items) > 1:
+                carrier["upload_file"], carrier["upload_index_file"] = \
+                    self._write_bundle(carrier, items)
+        except Exception as e:
+            for item in items:
+                item.log_output('Failed to write upload bundle: {0}'.format(e))
+                self.fail_item(item)
+            return
+
+        self._bundles[carrier] = items
+        for item in items[1:]:
+            item.log_output('Uploading as part of {0}.'.format(
+                os.path.basename(carrier["upload_file"])))
+        self._enqueue_inner_task_with_except(self.inner_task, carrier)
+
+    def _write_bundle(self, carrier, items):
+        bundle_file = "%(data_dir)s/%(warc_file_base)s-bundle.warc.gz" % carrier
+        bundle_index_file = "%(data_dir)s/%(warc_file_base)s-bundle.cdxj" % carrier
+        partial_file = bundle_file + ".partial"
+
+        # Every WARC record is its own gzip member, so concatenating the
+        # WARCs gives a valid .warc.gz.
+        with open(partial_file, "wb") as out_file:
+            for item in items:
+                with open(item["upload_file"], "rb") as in_file:
+                    shutil.copyfileobj(in_file, out_file)
+        os.rename(partial_file, bundle_file)
+
+        warc_check.merge_indexes(
+            [item["upload_index_file"] for item in items],
+            [os.path.getsize(item["upload_file"]) for item in items],
+            os.path.basename(bundle_file), bundle_index_file)
+
+        carrier.log_output('Bundled {0} items into {1}.'.format(
+            len(items), os.path.basename(bundle_file)))
+
+        return bundle_file, bundle_index_file
+
+    def _inner_task_complete_item(self, task, carrier):
+        items = self._bundles.pop(carrier)
+        if len(items) > 1:
+            for item in items:
+                os.remove("%(data_dir)s/%(warc_file_base)s.warc.gz" % item)
+                os.remove("%(data_dir)s/%(warc_file_base)s.cdxj" % item)
+        for item in items:
+            del item["upload_bytes"]
+            self.complete_item(item)
+
+    def _inner_task_fail_item(self, task, carrier):
+        for item in self._bundles.pop(carrier):
+            self.fail_item(item)
+
+    def fill_ui_task_list(self, task_list):
+        task_list.append((self, self.name))
+        self.inner_task.fill_ui_task_list(task_list)
 
 
 def get_hash(filename):
@@ -147,6 +1404,475 @@ CWD = os.getcwd()
 PIPELINE_SHA1 = get_hash(os.path.join(CWD, 'pipeline.py'))
 LUA_SHA1 = get_hash(os.path.join(CWD, 'wallbase.lua'))
 
+# CheckWarc runs warc_check.py, which sits next to this file, in a pool
+# of WARC_CHECK_PROCESSES processes (--context-value
+# warc_check_processes=N) and fails items whose check takes longer than
+# WARC_CHECK_TIMEOUT seconds.
+sys.path.insert(0, CWD)
+import warc_check
+WARC_CHECK_PROCESSES = int(globals().get('warc_check_processes', 2))
+WARC_CHECK_TIMEOUT = 600
+
+# Hit counts of the image URL variants, shared by all wget runs on this
+# machine. See the URL plan section in wallbase.lua.
+URL_PLAN_INDEX = os.path.join(CWD, 'url-plan-index.json')
+PREFETCH_QUEUE_FILE = os.path.join(CWD, 'prefetch-queue.json')
+
+# Items work in directories of a WorkdirPool in
+# WORKDIR_DIR/wallbase-workdirs (--context-value workdir_dir=DIR). Keep
+# it on the filesystem of ./data, so finished WARCs can be renamed into
+# place. --context-value scratch_dir=DIR puts Wget's throwaway output
+# elsewhere, e.g. on a tmpfs.
+WORKDIR_DIR = globals().get('workdir_dir', CWD)
+WORKDIR_SCRATCH_DIR = globals().get('scratch_dir')
+WORKDIR_POOL_SIZE = 4
+
+# The data directory of seesaw's Pipeline, and the log of AdmissionControl.
+DATA_DIR = os.path.join(CWD, 'data')
+ADMISSION_LOG = os.path.join(CWD, 'admission.log')
+
+
+# Payloads archived by any pipeline instance on this machine, so that
+# wget can write revisit records instead of storing them again.
+DEDUP_INDEX_FILE = os.path.join(CWD, 'dedup-index.sqlite3')
+DEDUP_INDEX_MAX_RECORDS = 100000
+DEDUP_FILE_MAX_RECORDS = 20000
+
+
+class DedupIndex(object):
+    """
+    A size-bounded index of archived payloads, keyed by the base32 SHA-1
+    payload digest from wget's CDX files.
+
+    SQLite does the locking, so several pipeline instances can share
+    the file. When it grows past max_records, the records that were
+    least recently seen are evicted.
+
+    Note that wget-lua 1.14 only writes a revisit record when the URL
+    matches as well as the digest.
+    """
+    def __init__(self, filename, max_records, max_export_records):
+        self.filename = filename
+        self.max_records = max_records
+        self.max_export_records = max_export_records
+
+        db = self.connect()
+        try:
+            db.execute("""CREATE TABLE IF NOT EXISTS records (
+                digest TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                record_id TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_seen REAL NOT NULL)""")
+            db.execute("""CREATE INDEX IF NOT EXISTS records_last_seen
+                ON records (last_seen)""")
+            db.execute("""CREATE INDEX IF NOT EXISTS records_record_id
+                ON records (record_id)""")
+            db.commit()
+        finally:
+            db.close()
+
+    def connect(self):
+        db = sqlite3.connect(self.filename, timeout=60)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def write_cdx(self, filename):
+        """Writes the most recently seen records, returns their number."""
+        db = self.connect()
+        try:
+            rows = db.execute("""SELECT url, digest, record_id FROM records
+                ORDER BY last_seen DESC LIMIT ?""", (self.max_export_records,)).fetchall()
+        finally:
+            db.close()
+
+        with open(filename, "w") as f:
+            f.write(" CDX a k u\n")
+            for url, digest, record_id in rows:
+                f.write("%s %s %s\n" % (url, digest, record_id))
+
+        return len(rows)
+
+    def _find_revisited(self, db, revisit_ids):
+        rows = []
+        for record_id in revisit_ids:
+            record_id = record_id.strip("<>")
+            row = db.execute("""SELECT record_id, size FROM records
+                WHERE record_id IN (?, ?)""", (record_id, "<%s>" % record_id)).fetchone()
+            if row:
+                rows.append(row)
+        return rows
+
+    def revisited_size(self, revisit_ids):
+        """Returns the size of the revisited records."""
+        db = self.connect()
+        try:
+            return sum(size for record_id, size in self._find_revisited(db, revisit_ids))
+        finally:
+            db.close()
+
+    def update(self, records, revisit_ids):
+        """
+        Adds new records, marks the revisited ones as seen and evicts
+        the oldest records. Returns the size of the revisited records.
+        """
+        now = time.time()
+        bytes_saved = 0
+
+        db = self.connect()
+        try:
+            for record_id, size in self._find_revisited(db, revisit_ids):
+                bytes_saved += size
+                db.execute("UPDATE records SET last_seen = ? WHERE record_id = ?",
+                    (now, record_id))
+
+            db.executemany("""INSERT OR IGNORE INTO records
+                (digest, url, record_id, size, last_seen) VALUES (?, ?, ?, ?, ?)""",
+                [(r["digest"], r["url"], r["record_id"], r["size"], now) for r in records])
+
+            count = db.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+            if count > self.max_records:
+                db.execute("""DELETE FROM records WHERE digest IN (
+                    SELECT digest FROM records ORDER BY last_seen LIMIT ?)""",
+                    (count - self.max_records,))
+
+            db.commit()
+        finally:
+            db.close()
+
+        return bytes_saved
+
+
+def read_cdx_records(filename, warc_size):
+    """
+    Reads a CDX file written by wget --warc-cdx. The size of a record is
+    estimated as the distance to the next listed record, which includes
+    the request record that wget writes in between.
+    """
+    records = []
+
+    with open(filename) as f:
+        fields = f.readline().split()[1:]
+        for line in f:
+            values = line.split()
+            if len(values) != len(fields):
+                continue
+            record = dict(zip(fields, values))
+            records.append({
+                "url": record["a"],
+                "digest": record["k"],
+                "record_id": record["u"],
+                "offset": int(record["V"]),
+            })
+
+    records.sort(key=lambda r: r["offset"])
+    for record, next_record in zip(records, records[1:] + [None]):
+        if next_record:
+            record["size"] = next_record["offset"] - record["offset"]
+        else:
+            record["size"] = warc_size - record["offset"]
+
+    return records
+
+
+def read_warc_headers(filename):
+    """Yields the headers of every record in a .warc.gz file as a dict."""
+    with gzip.open(filename, "rb") as f:
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            if not line.startswith(b"WARC/"):
+                continue
+
+            headers = {}
+            for line in iter(f.readline, b""):
+                line = line.rstrip(b"\r\n")
+                if not line:
+                    break
+                name, _, value = line.decode("utf-8", "replace").partition(":")
+                headers[name.strip()] = value.strip()
+
+            f.read(int(headers.get("Content-Length", 0)))
+            yield headers
+
+
+# Timings and counters of this pipeline instance, in the Prometheus text
+# format. Set another file with --context-value metrics_file=FILE when
+# several pipelines run from this directory.
+METRICS_FILE = globals().get('metrics_file', os.path.join(CWD, 'metrics.prom'))
+
+
+class Metrics(object):
+    """
+    Collects task timings, per-URL statistics from wallbase.lua, the
+    network check's resolution latency, the counters of the bind
+    addresses and the measurements of admission control, and writes
+    them to a file in the Prometheus text format (e.g. for the node
+    exporter's textfile collector). The file is rewritten at most every
+    write_interval seconds.
+    """
+    TASK_BUCKETS = [0.1, 1, 10, 60, 300, 1800, 3600]
+    # Has to match latency_bounds in wallbase.lua.
+    URL_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self, filename, network_check, address_pool,
+                 admission_control, write_interval=10):
+        self.filename = filename
+        self.network_check = network_check
+        self.address_pool = address_pool
+        self.admission_control = admission_control
+        self.write_interval = write_interval
+        self._task_seconds = {}
+        self._urls = {}
+        self._url_bytes = {}
+        self._url_seconds = {}
+        self._last_write = 0
+
+    def observe_task(self, task, item_type, result, seconds):
+        labels = (("task", task), ("item_type", item_type), ("result", result))
+        self._observe(self._task_seconds, labels, self.TASK_BUCKETS, seconds)
+        self.write()
+
+    def add_url_metrics(self, item_type, data):
+        labels = (("item_type", item_type),)
+
+        for status_code, count in data["status_codes"].items():
+            key = labels + (("status_code", status_code),)
+            self._urls[key] = self._urls.get(key, 0) + count
+
+        self._url_bytes[labels] = self._url_bytes.get(labels, 0) + data["bytes"]
+
+        series = self._url_seconds.setdefault(labels,
+            [[0] * (len(self.URL_BUCKETS) + 1), 0.0, 0])
+        for i, count in enumerate(data["latency_buckets"]):
+            series[0][i] += count
+        series[1] += data["latency_sum"]
+        series[2] += sum(data["latency_buckets"])
+
+        self.write()
+
+    def _observe(self, histograms, labels, buckets, value):
+        series = histograms.setdefault(labels, [[0] * (len(buckets) + 1), 0.0, 0])
+        for i, bound in enumerate(buckets + [float("inf")]):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def write(self, force=False):
+        if not force and time.time() - self._last_write < self.write_interval:
+            return
+        self._last_write = time.time()
+
+        tmp_file = self.filename + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.write(self.render())
+        os.rename(tmp_file, self.filename)
+
+    def render(self):
+        lines = []
+
+        self._render_histogram(lines, "wallbase_task_seconds", self.TASK_BUCKETS,
+            self._task_seconds)
+
+        lines.append("# TYPE wallbase_urls_total counter")
+        for labels, count in sorted(self._urls.items()):
+            lines.append("wallbase_urls_total{%s} %d" % (format_labels(labels), count))
+
+        lines.append("# TYPE wallbase_url_bytes_total counter")
+        for labels, count in sorted(self._url_bytes.items()):
+            lines.append("wallbase_url_bytes_total{%s} %d" % (format_labels(labels), count))
+
+        self._render_histogram(lines, "wallbase_url_seconds", self.URL_BUCKETS,
+            self._url_seconds)
+
+        lines.append("# TYPE wallbase_resolve_seconds gauge")
+        for hostname, seconds in sorted(self.network_check.latencies.items()):
+            lines.append("wallbase_resolve_seconds{%s} %f" % (
+                format_labels((("hostname", hostname),)), seconds))
+
+        for name, key, metric_type in [
+                ("wallbase_address_active", "active", "gauge"),
+                ("wallbase_address_runs_total", "runs", "counter"),
+                ("wallbase_address_urls_total", "urls", "counter"),
+                ("wallbase_address_bytes_total", "bytes", "counter"),
+                ("wallbase_address_errors_total", "errors", "counter"),
+                ("wallbase_address_throttled_total", "throttled", "counter"),
+                ("wallbase_address_quarantines_total", "quarantines", "counter")]:
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for address in self.address_pool.addresses:
+                lines.append("%s{%s} %d" % (name,
+                    format_labels((("address", address),)),
+                    self.address_pool.stats[address][key]))
+        lines.append("# TYPE wallbase_address_quarantined gauge")
+        for address in self.address_pool.addresses:
+            lines.append("wallbase_address_quarantined{%s} %d" % (
+                format_labels((("address", address),)),
+                self.address_pool.quarantined(address)))
+
+        admission_control = self.admission_control
+        for name, value in [
+                ("wallbase_admission_free_bytes", admission_control.free_bytes or 0),
+                ("wallbase_admission_backlog_bytes", admission_control.backlog_bytes),
+                ("wallbase_admission_upload_bytes_per_second", admission_control.upload_rate),
+                ("wallbase_admission_rsync_threads", admission_control.rsync_threads)]:
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s %f" % (name, value))
+        lines.append("# TYPE wallbase_admission_intake gauge")
+        for intake in ("open", "slow", "paused"):
+            lines.append("wallbase_admission_intake{%s} %d" % (
+                format_labels((("intake", intake),)),
+                admission_control.intake == intake))
+
+        return "\n".join(lines) + "\n"
+
+    def _render_histogram(self, lines, name, buckets, histograms):
+        lines.append("# TYPE %s histogram" % name)
+        for labels, (counts, total, count) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name,
+                    format_labels(labels), bound, cumulative))
+            lines.append("%s_sum{%s} %f" % (name, format_labels(labels), total))
+            lines.append("%s_count{%s} %d" % (name, format_labels(labels), count))
+
+
+def format_labels(labels):
+    return ",".join('%s="%s"' % (name, str(value).replace('"', '\\"'))
+        for name, value in labels)
+
+
+def get_item_type(item):
+    """The type of an item, "mixed" for a batch of several types."""
+    if "item_name" not in item:
+        return "none"
+    item_types = set(item_name.split(":", 1)[0]
+        for item_name in item["item_name"].split("\0"))
+    if len(item_types) == 1:
+        return item_types.pop()
+    return "mixed"
+
+
+def read_url_metrics(item, start=0):
+    """The URL metrics wallbase.lua wrote for each Wget run of an item."""
+    metrics_file = "%(item_dir)s/url_metrics.jsonl" % item
+    if not os.path.exists(metrics_file):
+        return []
+    with open(metrics_file) as f:
+        return [json.loads(line) for line in f if line.strip()][start:]
+
+
+def update_url_plan_index(filename, deltas):
+    """
+    Adds hit counts to the URL plan index. The index is shared by all
+    pipelines on this machine, so it is read, updated and replaced while
+    holding a lock on filename.lock.
+    """
+    with open(filename + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+        stats = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    stats = json.load(f)
+            except ValueError:
+                pass
+
+        for delta in deltas:
+            for key, counts in delta.items():
+                entry = stats.setdefault(key, {"hits": 0, "tries": 0})
+                entry["hits"] += counts["hits"]
+                entry["tries"] += counts["tries"]
+
+        tmp_file = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmp_file, "w") as f:
+            json.dump(stats, f)
+        os.rename(tmp_file, filename)
+
+
+def acquire_address(item):
+    release_address(item)
+    address = ADDRESS_POOL.acquire()
+    if address:
+        item['bind_address'] = address
+        item['bind_address_start'] = len(read_url_metrics(item))
+    return address
+
+
+def release_address(item):
+    if 'bind_address' not in item:
+        return
+    address = item['bind_address']
+    del item['bind_address']
+    if ADDRESS_POOL.release(address,
+            read_url_metrics(item, item['bind_address_start'])):
+        item.log_output('Too many errors, not using bind address {0} for {1} seconds.'.format(
+            address, ADDRESS_POOL.quarantine_time))
+
+
+def disk_free_bytes(path):
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def move_file(source, target):
+    """
+    Renames source to target if both are on the same filesystem.
+    Otherwise copies it, syncs the copy to disk and removes source.
+    Returns True if the file was copied.
+    """
+    if os.stat(source).st_dev == os.stat(os.path.dirname(target)).st_dev:
+        os.rename(source, target)
+        return False
+
+    partial_target = target + '.partial'
+    with open(source, 'rb') as in_file:
+        with open(partial_target, 'wb') as out_file:
+            shutil.copyfileobj(in_file, out_file, 1024 * 1024)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+    os.rename(partial_target, target)
+    os.remove(source)
+    return True
+
+
+DEDUP_INDEX = DedupIndex(DEDUP_INDEX_FILE, DEDUP_INDEX_MAX_RECORDS,
+    DEDUP_FILE_MAX_RECORDS)
+NETWORK_CHECK = NetworkCheck(CHECK_IP_HOSTNAMES, CHECK_IP_INTERVAL,
+    CHECK_IP_TIMEOUT)
+ADDRESS_POOL = AddressPool(BIND_ADDRESSES, ADDRESS_STORM_ERRORS,
+    ADDRESS_STORM_RATIO, ADDRESS_QUARANTINE_TIME)
+RSYNC_THREADS = NumberConfigValue(min=1, max=4,
+    default=globals().get('rsync_threads', "1"),
+    name="shared:rsync_threads", title="Rsync threads",
+    description="The maximum number of concurrent uploads.")
+ADMISSION_CONTROL = AdmissionControl([DATA_DIR, WORKDIR_DIR],
+    ADMISSION_MIN_FREE_BYTES, ADMISSION_MAX_BACKLOG_BYTES,
+    ADMISSION_SLOW_INTERVAL, ADMISSION_MIN_RSYNC_THREADS, RSYNC_THREADS,
+    ADMISSION_LOG)
+METRICS = Metrics(METRICS_FILE, NETWORK_CHECK, ADDRESS_POOL,
+    ADMISSION_CONTROL)
+WORKDIR_POOL = WorkdirPool(WORKDIR_DIR, WORKDIR_POOL_SIZE,
+    WORKDIR_SCRATCH_DIR)
+PREFETCH_QUEUE = PrefetchQueue(ITEM_REQUEST_URL, downloader, VERSION,
+    NETWORK_CHECK, ADMISSION_CONTROL, PREFETCH_QUEUE_FILE, PREFETCH_MIN_DEPTH,
+    PREFETCH_MAX_DEPTH, PREFETCH_MAX_AGE, PREFETCH_LEAD_TIME)
+atexit.register(METRICS.write, force=True)
+
 
 def stats_id_function(item):
     # NEW for 2014! Some accountability hashes and stats.
@@ -156,9 +1882,150 @@ def stats_id_function(item):
         'python_version': sys.version,
     }
 
+    if 'warc_check' in item:
+        d['warc_records'] = item['warc_check']['records']
+        d['warc_types'] = item['warc_check']['warc_types']
+        d['status_codes'] = item['warc_check']['status_codes']
+        d['mime_types'] = item['warc_check']['mime_types']
+
+    if 'dedup_hits' in item:
+        d['dedup_hits'] = item['dedup_hits']
+        d['dedup_bytes_saved'] = item['dedup_bytes_saved']
+        d['dedup_hit_rate'] = float(item['dedup_hits']) / max(1,
+            item['dedup_hits'] + item['dedup_responses'])
+
     return d
 
 
+def get_done_urls(item):
+    """
+    Returns the URLs that earlier WARC segments of the item already
+    contain, as listed in the manifest kept by wallbase.lua.
+    """
+    done_urls = set()
+    manifest_file = "%(item_dir)s/manifest.txt" % item
+
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            for line in f:
+                parts = line.rstrip('\n').split(' ', 1)
+                if len(parts) == 2:
+                    done_urls.add(parts[1])
+
+    return done_urls
+
+
+def get_item_urls(item_type, item_value):
+    urls = []
+
+    if item_type == 'wallpaper':
+        #example url: http://wallbase.cc/wallpaper/2940947
+        #example item: wallpaper:2940947
+        urls.append('http://wallbase.cc/wallpaper/{0}'.format(item_value))
+        urls.append('http://wallbase.cc/index.php/wallpaper/index/{0}'.format(item_value))
+        # The full-size image and thumbnails are planned by wallbase.lua
+        # once it has seen the wallpaper page.
+        urls.append('http://wallbase.cc/wallpaper/go/{0}/next'.format(item_value))
+        urls.append('http://wallbase.cc/wallpaper/go/{0}/prev'.format(item_value))
+        urls.append('http://wallbase.cc/wallpaper/go/{0}/next/'.format(item_value))
+        urls.append('http://wallbase.cc/wallpaper/go/{0}/prev/'.format(item_value))
+        urls.append('http://wallbase.cc/wallpaper/similar/{0}'.format(item_value))
+        urls.append('http://wallbase.cc/wallpaper/add_copyright/{0}'.format(item_value))
+        urls.append('http://wallbase.cc/wallpaper/load_grouped_walls/{0}'.format(item_value))
+        urls.append('http://wallbase.cc/wallpaper/purity/{0}/2'.format(item_value))
+        urls.append('http://wallbase.cc/wallpaper/purity/{0}/1'.format(item_value))
+        urls.append('http://wallbase.cc/wallpaper/purity/{0}/0'.format(item_value))
+        urls.append('http://wallbase.cc/index.php/wallpaper/delete/{0}'.format(item_value))
+        urls.append('http://wallbase.cc/wallpaper/add2favorites/{0}/0'.format(item_value))
+        urls.append('http://wallbase.cc/wallpaper/add2favorites/{0}/1'.format(item_value))
+        urls.append('http://wallbase.cc/wallpaper/delete/{0}/rep'.format(item_value))
+        urls.append('http://walb.es/{0}'.format(item_value))
+    elif item_type == 'tag':
+        #example url: http://wallbase.cc/search?tag=8179
+        #example item: tag:8179:fate/stay night
+        if ':' in item_value:
+            item_num, item_name = item_value.split(':', 1)
+            urls.append('http://wallbase.cc/search?tag={0}'.format(item_num))
+            urls.append('http://wallbase.cc/search/index/?tag={0}'.format(item_num))
+            urls.append('http://wallbase.cc/search/index/0?tag={0}'.format(item_num))
+            urls.append('http://wallbase.cc/search/index/60?tag={0}'.format(item_num))
+            urls.append('http://wallbase.cc/tags/{0}'.format(item_num))
+            urls.append('http://wallbase.cc/tags/{0}/'.format(item_num))
+            urls.append('http://wallbase.cc/tags/info/{0}'.format(item_num))
+            urls.append('http://wallbase.cc/tags/subscribe/{0}/1'.format(item_num))
+            urls.append('http://wallbase.cc/tags/subscribe/{0}/0'.format(item_num))
+            urls.append('http://wallbase.cc/search?q==({0})'.format(item_name))
+            urls.append('http://wallbase.cc/search?q==({0})&color=&section=wallpapers&q==({0})&res_opt=eqeq&res=0x0&order_mode=desc&thpp=60&purity=111&board=213&aspect=0.00'.format(item_name))
+            if '/' in item_name:
+                item_value.replace('/', ' ')
+                urls.append('http://wallbase.cc/search?q==({0})'.format(item_name))
+                urls.append('http://wallbase.cc/search?q==({0})&color=&section=wallpapers&q==({0})&res_opt=eqeq&res=0x0&order_mode=desc&thpp=60&purity=111&board=213&aspect=0.00'.format(item_name))
+        else:
+            urls.append('http://wallbase.cc/search?tag={0}'.format(item_value))
+            urls.append('http://wallbase.cc/search/index/?tag={0}'.format(item_value))
+            urls.append('http://wallbase.cc/search/index/0?tag={0}'.format(item_value))
+            urls.append('http://wallbase.cc/search/index/60?tag={0}'.format(item_value))
+            urls.append('http://wallbase.cc/tags/{0}'.format(item_value))
+            urls.append('http://wallbase.cc/tags/{0}/'.format(item_value))
+            urls.append('http://wallbase.cc/tags/info/{0}'.format(item_value))
+            urls.append('http://wallbase.cc/tags/subscribe/{0}/1'.format(item_value))
+            urls.append('http://wallbase.cc/tags/subscribe/{0}/0'.format(item_value))
+    elif item_type == 'user':
+        #example url: http://wallbase.cc/user/id-2
+        #example item: user:2
+        urls.append('http://wallbase.cc/user/id-{0}'.format(item_value))
+        urls.append('http://wallbase.cc/user/id-{0}/'.format(item_value))
+        urls.append('http://wallbase.cc/user/subscribe/{0}/1'.format(item_value))
+        urls.append('http://wallbase.cc/user/subscribe/{0}/0'.format(item_value))
+        urls.append('http://wallbase.cc/user/id-{0}/favorites'.format(item_value))
+        urls.append('http://wallbase.cc/user/id-{0}/uploads'.format(item_value))
+        urls.append('http://wallbase.cc/images/avatars/av_{0}.gif'.format(item_value))
+        urls.append('http://wallbase.cc/images/avatars/av_{0}.png'.format(item_value))
+        urls.append('http://wallbase.cc/images/avatars/av_{0}.jpg'.format(item_value))
+    elif item_type == 'collection':
+        #example url: http://wallbase.cc/collection/26215
+        #example item: collection:26215
+        urls.append('http://wallbase.cc/collection/{0}'.format(item_value))
+        urls.append('http://wallbase.cc/collection/{0}/'.format(item_value))
+        urls.append('http://wallbase.cc/collection/rate_coll/{0}/down'.format(item_value))
+        urls.append('http://wallbase.cc/collection/rate_coll/{0}/up'.format(item_value))
+    elif item_type == 'color':
+        #example url: http://wallbase.cc/search?color=69413a
+        #example item: color:69413a
+        urls.append('http://wallbase.cc/search?color={0}'.format(item_value))
+        urls.append('http://wallbase.cc/search?q=&section=wallpapers&board=12&res_opt=eqeq&res=0x0&aspect=0&purity=100&order=def_relevance&order_mode=desc&thpp=32&r=145&g=150&b=181&color={0}'.format(item_value))
+    elif item_type == 'toplist':
+        #example url: http://wallbase.cc/toplist?ts=1w
+        #example item: toplist:1w
+        urls.append('http://wallbase.cc/toplist?ts={0}'.format(item_value))
+        urls.append('http://wallbase.cc/toplist?section=wallpapers&board=12&res_opt=eqeq&res=0x0&aspect=0&purity=100&thpp=32&ts={0}'.format(item_value))
+        urls.append('http://wallbase.cc/toplist?section=collections&board=12&res_opt=eqeq&res=0x0&aspect=0&purity=100&thpp=32&ts={0}'.format(item_value))
+    elif item_type == 'screenshot':
+        #example url: http://wallbase.cc/user/screenshot/3759
+        #example item: screenshot:3759
+        urls.append('http://wallbase.cc/user/screenshot/{0}'.format(item_value))
+        urls.append('http://slave.wallbase.cc/desktops/desk_{0}.jpg'.format(item_value))
+        urls.append('http://slave.wallbase.cc/desktops/desk_{0}_orig.jpg'.format(item_value))
+        urls.append('http://slave.wallbase.cc/desktops/desk_{0}_orig.jpg#-moz-resolution=16,16'.format(item_value))
+        urls.append('http://slave.wallbase.cc/desktops/desk_{0}.png'.format(item_value))
+        urls.append('http://slave.wallbase.cc/desktops/desk_{0}.gif'.format(item_value))
+    elif item_type == 'favorite':
+        #example url: http://wallbase.cc/favorites/570499
+        #example item: favorite:570499
+        urls.append('http://wallbase.cc/favorites/{0}'.format(item_value))
+        urls.append('http://wallbase.cc/favorites/{0}/'.format(item_value))
+        urls.append('http://wallbase.cc/favorites/change_perms/{0}/1'.format(item_value))
+        urls.append('http://wallbase.cc/favorites/change_perms/{0}/0'.format(item_value))
+        urls.append('http://wallbase.cc/index.php/favorites/rename_coll/{0}'.format(item_value))
+        urls.append('http://wallbase.cc/index.php/favorites/new_coll/{0}'.format(item_value))
+        urls.append('http://wallbase.cc/favorites/delete_coll/{0}/delall'.format(item_value))
+        urls.append('http://wallbase.cc/favorites/delete_coll/{0}/delroot'.format(item_value))
+    else:
+        raise Exception('Unknown item')
+
+    return urls
+
+
 class WgetArgs(object):
     def realize(self, item):
         wget_args = [
@@ -168,7 +2035,7 @@ class WgetArgs(object):
             "--lua-script", "wallbase.lua",
             "-o", ItemInterpolation("%(item_dir)s/wget.log"),
             "--no-check-certificate",
-            "--output-document", ItemInterpolation("%(item_dir)s/wget.tmp"),
+            "--output-document", ItemInterpolation("%(scratch_dir)s/wget.tmp"),
             "--truncate-output",
             "-e", "robots=off",
             "--no-cookies",
@@ -180,160 +2047,63 @@ class WgetArgs(object):
             "--tries", "inf",
             "--span-hosts",
             "--waitretry", "30",
+            "--wait", str(WGET_WAIT),
+            "--random-wait",
             "--domains", "wallbase.cc,walb.es",
-            "--warc-file", ItemInterpolation("%(item_dir)s/%(warc_file_base)s"),
+            "--warc-file", ItemInterpolation("%(item_dir)s/%(warc_file_base)s-%(warc_segment)05d"),
             "--warc-header", "operator: Archive Team",
             "--warc-header", "wallbase-dld-script-version: " + VERSION,
-            "--warc-header", ItemInterpolation("wallbase-user: %(item_name)s"),
+            "--warc-cdx",
         ]
+
+        if item["dedup_records"] > 0:
+            wget_args.extend(["--warc-dedup", ItemInterpolation("%(item_dir)s/dedup.cdx")])
         
-        item_name = item['item_name']
-        assert ':' in item_name
-        item_type, item_value = item_name.split(':', 1)
-        
-        item['item_type'] = item_type
-        item['item_value'] = item_value
-        
-        assert item_type in ('wallpaper', 'tag', 'user', 'collection', 'color', 'toplist', 'screenshot', 'favorite')
-        
-        if item_type == 'wallpaper':
-            #example url: http://wallbase.cc/wallpaper/2940947
-            #example item: wallpaper:2940947
-            wget_args.append('http://wallbase.cc/wallpaper/{0}'.format(item_value))
-            wget_args.append('http://wallbase.cc/index.php/wallpaper/index/{0}'.format(item_value))
-            wget_args.append('http://wallpapers.wallbase.cc/high-resolution/wallpaper-{0}.jpg'.format(item_value))
-            wget_args.append('http://wallpapers.wallbase.cc/manga-anime/wallpaper-{0}.jpg'.format(item_value))
-            wget_args.append('http://wallpapers.wallbase.cc/rozne/wallpaper-{0}.jpg'.format(item_value))
-            wget_args.append('http://wallpapers.wallbase.cc/high-resolution/wallpaper-{0}.png'.format(item_value))
-            wget_args.append('http://wallpapers.wallbase.cc/manga-anime/wallpaper-{0}.png'.format(item_value))
-            wget_args.append('http://wallpapers.wallbase.cc/rozne/wallpaper-{0}.png'.format(item_value))
-            wget_args.append('http://wallpapers.wallbase.cc/high-resolution/wallpaper-{0}.gif'.format(item_value))
-            wget_args.append('http://wallpapers.wallbase.cc/manga-anime/wallpaper-{0}.gif'.format(item_value))
-            wget_args.append('http://wallpapers.wallbase.cc/rozne/wallpaper-{0}.gif'.format(item_value))
-            wget_args.append('http://wallbase.cc/wallpaper/go/{0}/next'.format(item_value))
-            wget_args.append('http://wallbase.cc/wallpaper/go/{0}/prev'.format(item_value))
-            wget_args.append('http://wallbase.cc/wallpaper/go/{0}/next/'.format(item_value))
-            wget_args.append('http://wallbase.cc/wallpaper/go/{0}/prev/'.format(item_value))
-            wget_args.append('http://origthumbs.wallbase.cc//rozne/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://origthumbs.wallbase.cc//high-resolution/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://origthumbs.wallbase.cc//manga-anime/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://thumbs.wallbase.cc//rozne/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://thumbs.wallbase.cc//high-resolution/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://thumbs.wallbase.cc//manga-anime/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://sthumbs.wallbase.cc//rozne/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://sthumbs.wallbase.cc//high-resolution/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://sthumbs.wallbase.cc//manga-anime/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://origthumbs.wallbase.cc/rozne/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://origthumbs.wallbase.cc/high-resolution/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://origthumbs.wallbase.cc/manga-anime/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://thumbs.wallbase.cc/rozne/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://thumbs.wallbase.cc/high-resolution/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://thumbs.wallbase.cc/manga-anime/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://sthumbs.wallbase.cc/rozne/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://sthumbs.wallbase.cc/high-resolution/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://sthumbs.wallbase.cc/manga-anime/thumb-{0}.jpg'.format(item_value))
-            wget_args.append('http://wallbase.cc/wallpaper/similar/{0}'.format(item_value))
-            wget_args.append('http://wallbase.cc/wallpaper/add_copyright/{0}'.format(item_value))
-            wget_args.append('http://wallbase.cc/wallpaper/load_grouped_walls/{0}'.format(item_value))
-            wget_args.append('http://wallbase.cc/wallpaper/purity/{0}/2'.format(item_value))
-            wget_args.append('http://wallbase.cc/wallpaper/purity/{0}/1'.format(item_value))
-            wget_args.append('http://wallbase.cc/wallpaper/purity/{0}/0'.format(item_value))
-            wget_args.append('http://wallbase.cc/index.php/wallpaper/delete/{0}'.format(item_value))
-            wget_args.append('http://wallbase.cc/wallpaper/add2favorites/{0}/0'.format(item_value))
-            wget_args.append('http://wallbase.cc/wallpaper/add2favorites/{0}/1'.format(item_value))
-            wget_args.append('http://wallbase.cc/wallpaper/delete/{0}/rep'.format(item_value))
-            wget_args.append('http://walb.es/{0}'.format(item_value))
-        elif item_type == 'tag':
-            #example url: http://wallbase.cc/search?tag=8179
-            #example item: tag:8179:fate/stay night
-            if ':' in item_value:
-                item_num, item_name = item_value.split(':', 1)
-                item['item_num'] = item_num
-                item['item_name'] = item_name
-                wget_args.append('http://wallbase.cc/search?tag={0}'.format(item_num))
-                wget_args.append('http://wallbase.cc/search/index/?tag={0}'.format(item_num))
-                wget_args.append('http://wallbase.cc/search/index/0?tag={0}'.format(item_num))
-                wget_args.append('http://wallbase.cc/search/index/60?tag={0}'.format(item_num))
-                wget_args.append('http://wallbase.cc/tags/{0}'.format(item_num))
-                wget_args.append('http://wallbase.cc/tags/{0}/'.format(item_num))
-                wget_args.append('http://wallbase.cc/tags/info/{0}'.format(item_num))
-                wget_args.append('http://wallbase.cc/tags/subscribe/{0}/1'.format(item_num))
-                wget_args.append('http://wallbase.cc/tags/subscribe/{0}/0'.format(item_num))
-                wget_args.append('http://wallbase.cc/search?q==({0})'.format(item_name))
-                wget_args.append('http://wallbase.cc/search?q==({0})&color=&section=wallpapers&q==({0})&res_opt=eqeq&res=0x0&order_mode=desc&thpp=60&purity=111&board=213&aspect=0.00'.format(item_name))
-                if '/' in item_name:
-                    item_value.replace('/', ' ')
-                    wget_args.append('http://wallbase.cc/search?q==({0})'.format(item_name))
-                    wget_args.append('http://wallbase.cc/search?q==({0})&color=&section=wallpapers&q==({0})&res_opt=eqeq&res=0x0&order_mode=desc&thpp=60&purity=111&board=213&aspect=0.00'.format(item_name))
-            else:
-                wget_args.append('http://wallbase.cc/search?tag={0}'.format(item_value))
-                wget_args.append('http://wallbase.cc/search/index/?tag={0}'.format(item_value))
-                wget_args.append('http://wallbase.cc/search/index/0?tag={0}'.format(item_value))
-                wget_args.append('http://wallbase.cc/search/index/60?tag={0}'.format(item_value))
-                wget_args.append('http://wallbase.cc/tags/{0}'.format(item_value))
-                wget_args.append('http://wallbase.cc/tags/{0}/'.format(item_value))
-                wget_args.append('http://wallbase.cc/tags/info/{0}'.format(item_value))
-                wget_args.append('http://wallbase.cc/tags/subscribe/{0}/1'.format(item_value))
-                wget_args.append('http://wallbase.cc/tags/subscribe/{0}/0'.format(item_value))
-        elif item_type == 'user':
-            #example url: http://wallbase.cc/user/id-2
-            #example item: user:2
-            wget_args.append('http://wallbase.cc/user/id-{0}'.format(item_value))
-            wget_args.append('http://wallbase.cc/user/id-{0}/'.format(item_value))
-            wget_args.append('http://wallbase.cc/user/subscribe/{0}/1'.format(item_value))
-            wget_args.append('http://wallbase.cc/user/subscribe/{0}/0'.format(item_value))
-            wget_args.append('http://wallbase.cc/user/id-{0}/favorites'.format(item_value))
-            wget_args.append('http://wallbase.cc/user/id-{0}/uploads'.format(item_value))
-            wget_args.append('http://wallbase.cc/images/avatars/av_{0}.gif'.format(item_value))
-            wget_args.append('http://wallbase.cc/images/avatars/av_{0}.png'.format(item_value))
-            wget_args.append('http://wallbase.cc/images/avatars/av_{0}.jpg'.format(item_value))
-        elif item_type == 'collection':
-            #example url: http://wallbase.cc/collection/26215
-            #example item: collection:26215
-            wget_args.append('http://wallbase.cc/collection/{0}'.format(item_value))
-            wget_args.append('http://wallbase.cc/collection/{0}/'.format(item_value))
-            wget_args.append('http://wallbase.cc/collection/rate_coll/{0}/down'.format(item_value))
-            wget_args.append('http://wallbase.cc/collection/rate_coll/{0}/up'.format(item_value))
-        elif item_type == 'color':
-            #example url: http://wallbase.cc/search?color=69413a
-            #example item: color:69413a
-            wget_args.append('http://wallbase.cc/search?color={0}'.format(item_value))
-            wget_args.append('http://wallbase.cc/search?q=&section=wallpapers&board=12&res_opt=eqeq&res=0x0&aspect=0&purity=100&order=def_relevance&order_mode=desc&thpp=32&r=145&g=150&b=181&color={0}'.format(item_value))
-        elif item_type == 'toplist':
-            #example url: http://wallbase.cc/toplist?ts=1w
-            #example item: toplist:1w
-            wget_args.append('http://wallbase.cc/toplist?ts={0}'.format(item_value))
-            wget_args.append('http://wallbase.cc/toplist?section=wallpapers&board=12&res_opt=eqeq&res=0x0&aspect=0&purity=100&thpp=32&ts={0}'.format(item_value))
-            wget_args.append('http://wallbase.cc/toplist?section=collections&board=12&res_opt=eqeq&res=0x0&aspect=0&purity=100&thpp=32&ts={0}'.format(item_value))
-        elif item_type == 'screenshot':
-            #example url: http://wallbase.cc/user/screenshot/3759
-            #example item: screenshot:3759
-            wget_args.append('http://wallbase.cc/user/screenshot/{0}'.format(item_value))
-            wget_args.append('http://slave.wallbase.cc/desktops/desk_{0}.jpg'.format(item_value))
-            wget_args.append('http://slave.wallbase.cc/desktops/desk_{0}_orig.jpg'.format(item_value))
-            wget_args.append('http://slave.wallbase.cc/desktops/desk_{0}_orig.jpg#-moz-resolution=16,16'.format(item_value))
-            wget_args.append('http://slave.wallbase.cc/desktops/desk_{0}.png'.format(item_value))
-            wget_args.append('http://slave.wallbase.cc/desktops/desk_{0}.gif'.format(item_value))
-        elif item_type == 'favorite':
-            #example url: http://wallbase.cc/favorites/570499
-            #example item: favorite:570499
-            wget_args.append('http://wallbase.cc/favorites/{0}'.format(item_value))
-            wget_args.append('http://wallbase.cc/favorites/{0}/'.format(item_value))
-            wget_args.append('http://wallbase.cc/favorites/change_perms/{0}/1'.format(item_value))
-            wget_args.append('http://wallbase.cc/favorites/change_perms/{0}/0'.format(item_value))
-            wget_args.append('http://wallbase.cc/index.php/favorites/rename_coll/{0}'.format(item_value))
-            wget_args.append('http://wallbase.cc/index.php/favorites/new_coll/{0}'.format(item_value))
-            wget_args.append('http://wallbase.cc/favorites/delete_coll/{0}/delall'.format(item_value))
-            wget_args.append('http://wallbase.cc/favorites/delete_coll/{0}/delroot'.format(item_value))
+        # Every try of WgetDownload writes a new WARC segment and only
+        # fetches what the earlier ones don't have yet. MergeWarcSegments
+        # puts them together afterwards.
+        if 'warc_segment' in item:
+            item['warc_segment'] += 1
         else:
-            raise Exception('Unknown item')
-        
-        if 'bind_address' in globals():
-            wget_args.extend(['--bind-address', globals()['bind_address']])
-            print('')
-            print('*** Wget will bind address at {0} ***'.format(
-                globals()['bind_address']))
-            print('')
+            item['warc_segment'] = 0
+        done_urls = get_done_urls(item)
+
+        item_names = item['item_name'].split('\0')
+        item_urls = []
+
+        for item_name in item_names:
+            assert ':' in item_name
+            item_type, item_value = item_name.split(':', 1)
+            assert item_type in ('wallpaper', 'tag', 'user', 'collection', 'color', 'toplist', 'screenshot', 'favorite')
+
+            wget_args.extend(["--warc-header", "wallbase-user: " + item_name])
+
+            for url in get_item_urls(item_type, item_value):
+                if url not in done_urls:
+                    wget_args.append(url)
+                item_urls.append((item_name, url))
+
+        # For single items these are used as before; for a batch they
+        # describe the first item.
+        item['item_type'], item['item_value'] = item_names[0].split(':', 1)
+
+        # Tell the Lua script which item every start URL belongs to, so
+        # it can blame a failing URL on its own item only.
+        with open("%(item_dir)s/item_urls.txt" % item, "w") as f:
+            for item_name, url in item_urls:
+                f.write("%s\t%s\n" % (item_name, url))
+
+        if HTTP_PROXY:
+            wget_args.extend([
+                "-e", "use_proxy=on",
+                "-e", "http_proxy=http://%s/" % HTTP_PROXY,
+            ])
+
+        bind_address = acquire_address(item)
+        if bind_address:
+            wget_args.extend(['--bind-address', bind_address])
+            item.log_output('*** Wget will bind address at {0} ***'.format(
+                bind_address))
 
         return realize(wget_args, item)
 
@@ -352,11 +2122,13 @@ project = Project(
 )
 
 pipeline = Pipeline(
-    CheckIP(),
-    GetItemFromTracker("http://%s/%s" % (TRACKER_HOST, TRACKER_ID), downloader,
-        VERSION),
-    PrepareDirectories(warc_prefix="wallbase"),
-    WgetDownload(
+    TimedTask(CheckIP(NETWORK_CHECK)),
+    TimedTask(AdmitItem(ADMISSION_CONTROL)),
+    TimedTask(GetPrefetchedItem(PREFETCH_QUEUE)),
+    TimedTask(PrepareDirectories(warc_prefix="wallbase",
+        workdir_pool=WORKDIR_POOL)),
+    TimedTask(WriteDedupFile(DEDUP_INDEX)),
+    TimedTask(BindAddress(WgetDownload(
         WgetArgs(),
         max_tries=5,
         accept_on_exit_code=[0, 8],
@@ -364,9 +2136,17 @@ pipeline = Pipeline(
             "item_dir": ItemValue("item_dir"),
             "item_value": ItemValue("item_value"),
             "item_type": ItemValue("item_type"),
+            "url_plan_index": URL_PLAN_INDEX,
+            "wget_wait": str(WGET_WAIT),
         }
-    ),
-    PrepareStatsForTracker(
+    ), ADDRESS_POOL), name="WgetDownload"),
+    CollectUrlMetrics(),
+    TimedTask(UpdateUrlPlanIndex(URL_PLAN_INDEX)),
+    TimedTask(DropFailedItems()),
+    TimedTask(ReadDedupRecords(DEDUP_INDEX)),
+    TimedTask(MergeWarcSegments()),
+    TimedTask(CheckWarc(WARC_CHECK_PROCESSES, WARC_CHECK_TIMEOUT)),
+    TimedTask(PrepareStatsForTracker(
         defaults={"downloader": downloader, "version": VERSION},
         file_groups={
             "data": [
@@ -374,28 +2154,33 @@ pipeline = Pipeline(
             ]
         },
         id_function=stats_id_function,
-    ),
-    MoveFiles(),
-    LimitConcurrent(NumberConfigValue(min=1, max=4, default="1",
-        name="shared:rsync_threads", title="Rsync threads",
-        description="The maximum number of concurrent uploads."),
-        UploadWithTracker(
-            "http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
-            downloader=downloader,
-            version=VERSION,
-            files=[
-                ItemInterpolation("%(data_dir)s/%(warc_file_base)s.warc.gz")
-            ],
-            rsync_target_source_path=ItemInterpolation("%(data_dir)s/"),
-            rsync_extra_args=[
-                "--recursive",
-                "--partial",
-                "--partial-dir", ".rsync-tmp",
-            ]
-            ),
-    ),
-    SendDoneToTracker(
+    )),
+    TimedTask(MoveFiles(WORKDIR_POOL)),
+    TimedTask(CoalesceUploads(
+        TimedTask(LimitConcurrent(UploadConcurrency(ADMISSION_CONTROL),
+            TimedTask(MeasureUpload(UploadWithTracker(
+                "http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
+                downloader=downloader,
+                version=VERSION,
+                files=[
+                    ItemInterpolation("%(upload_file)s"),
+                    ItemInterpolation("%(upload_index_file)s"),
+                ],
+                rsync_target_source_path=ItemInterpolation("%(data_dir)s/"),
+                rsync_extra_args=[
+                    "--recursive",
+                    "--partial",
+                    "--partial-dir", ".rsync-tmp",
+                ]
+                ), ADMISSION_CONTROL), name="UploadWithTracker"),
+        )),
+        max_size=BUNDLE_MAX_SIZE,
+        max_age=BUNDLE_MAX_AGE,
+        max_items=BUNDLE_MAX_ITEMS,
+    )),
+    TimedTask(UpdateDedupIndex(DEDUP_INDEX)),
+    TimedTask(SendDoneToTracker(
         tracker_url="http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
         stats=ItemValue("stats")
-    )
+    ))
 )
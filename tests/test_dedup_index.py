@@ -0,0 +1,111 @@
+# encoding=utf8
+'''
+Checks that the dedup index only learns about the responses of an item
+once the item has been uploaded. Loads pipeline.py the way run-pipeline
+does, so it needs seesaw and Wget+Lua.
+'''
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+try:
+    from seesaw.item import Item
+    from seesaw.pipeline import Pipeline
+    from seesaw.script.run_pipeline import load_pipeline
+    from seesaw.task import SimpleTask
+except Exception:
+    # Older seesaw releases do not import on newer Pythons.
+    load_pipeline = None
+
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WARC_RECORD = (b'WARC/1.0\r\n'
+    b'WARC-Type: response\r\n'
+    b'WARC-Record-ID: <urn:uuid:00000000-0000-0000-0000-000000000001>\r\n'
+    b'WARC-Target-URI: http://wallpapers.wallbase.cc/rozne/wallpaper-1.jpg\r\n'
+    b'Content-Length: 4\r\n'
+    b'\r\n'
+    b'jpeg\r\n\r\n')
+CDX = (' CDX a k u V\n'
+    'http://wallpapers.wallbase.cc/rozne/wallpaper-1.jpg AAAA '
+    '<urn:uuid:00000000-0000-0000-0000-000000000001> 0\n')
+
+
+if load_pipeline is not None:
+    class Upload(SimpleTask):
+        '''Stands in for the upload, which fails if fail is set.'''
+        def __init__(self):
+            SimpleTask.__init__(self, "Upload")
+            self.fail = False
+
+        def process(self, item):
+            if self.fail:
+                raise Exception('Upload failed.')
+
+
+@unittest.skipIf(load_pipeline is None, 'needs seesaw')
+class DedupIndexTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.context = {'downloader': 'test'}
+        try:
+            load_pipeline(os.path.join(REPO, 'pipeline.py'), cls.context)
+        except Exception as e:
+            raise unittest.SkipTest('cannot load pipeline.py: %s' % e)
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.workdir, 'dedup-index.sqlite3')
+        dedup_index = self.context['DedupIndex'](self.index_file, 100, 100)
+        self.upload = Upload()
+        self.pipeline = Pipeline(
+            self.context['ReadDedupRecords'](dedup_index),
+            self.upload,
+            self.context['UpdateDedupIndex'](dedup_index),
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def run_item(self):
+        item_dir = tempfile.mkdtemp(dir=self.workdir)
+        with gzip.open(os.path.join(item_dir, 'item-00000.warc.gz'), 'wb') as f:
+            f.write(WARC_RECORD)
+        with open(os.path.join(item_dir, 'item-00000.cdx'), 'w') as f:
+            f.write(CDX)
+
+        item = Item(self.pipeline, 'item', 1, keep_data=True,
+            prepare_data_directory=False, properties={'data_dir': item_dir,
+                'item_dir': item_dir, 'warc_file_base': 'item'})
+        self.pipeline.enqueue(item)
+        return item
+
+    def indexed_digests(self):
+        db = sqlite3.connect(self.index_file)
+        try:
+            return [row[0] for row in db.execute('SELECT digest FROM records')]
+        finally:
+            db.close()
+
+    def test_failed_upload(self):
+        self.upload.fail = True
+        item = self.run_item()
+        self.assertEqual(item.item_state, Item.ItemState.failed)
+        self.assertEqual(self.indexed_digests(), [])
+
+    def test_upload(self):
+        item = self.run_item()
+        self.assertEqual(item.item_state, Item.ItemState.completed)
+        self.assertEqual(self.indexed_digests(), ['AAAA'])
+
+    def test_pipeline_order(self):
+        names = [getattr(task, 'timed_name', task.name) for task in self.context['pipeline'].tasks]
+        self.assertLess(names.index('CoalesceUploads'), names.index('UpdateDedupIndex'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# encoding=utf8
+'''
+Checks that wallbase.lua fetches the same search result pages as a page
+by page crawl would.
+Runs the script with bench/replay_crawl.py, so it needs lupa.
+'''
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'bench'))
+
+import fake_wallbase
+try:
+    import replay_crawl
+except ImportError:
+    replay_crawl = None
+
+
+TOTALS = [0, 1, 31, 32, 33, 59, 60, 61, 64, 100, 200, 2000]
+SEARCHES = [
+    ('http://wallbase.cc/search/index/', '?tag=1', 32),
+    ('http://wallbase.cc/search/', '?tag=1', 60),
+]
+
+
+class SearchSite(fake_wallbase.Site):
+    '''
+    The fake site, with a given number of results for every search.
+    '''
+    def __init__(self):
+        fake_wallbase.Site.__init__(self)
+        self.total = 0
+
+    def result_count(self, query):
+        return self.total
+
+
+def sequential_offsets(total, step):
+    '''The offsets a page by page crawl fetches.'''
+    offsets = [0]
+    while offsets[-1] < total:
+        offsets.append(offsets[-1] + step)
+    return offsets
+
+
+@unittest.skipIf(replay_crawl is None, 'needs lupa')
+class PaginationTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.site = SearchSite()
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def crawl_offsets(self, prefix, suffix):
+        start_url = prefix + '0' + suffix
+        item_dir = tempfile.mkdtemp(dir=self.workdir)
+        script = replay_crawl.Script(item_dir,
+            os.path.join(self.workdir, 'url-plan-index.json'),
+            [('tag:1', start_url)])
+        fetched = replay_crawl.crawl(script, self.site, [start_url], item_dir)
+        pattern = '^%s([0-9]+)%s$' % (re.escape(prefix), re.escape(suffix))
+        return [int(re.match(pattern, url).group(1)) for url, status_code in fetched]
+
+    def test_pages(self):
+        for prefix, suffix, step in SEARCHES:
+            for total in TOTALS:
+                self.site.total = total
+                self.assertEqual(sorted(self.crawl_offsets(prefix, suffix)),
+                    sequential_offsets(total, step),
+                    '%d results at %s' % (total, prefix))
+
+
+if __name__ == '__main__':
+    unittest.main()
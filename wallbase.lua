@@ -4,6 +4,30 @@ JSON = (loadfile "JSON.lua")()
 
 local url_count = 0
 local tries = 0
+local item_dir = os.getenv('item_dir')
+
+-- Which item of a batch each URL belongs to. The start URLs come from
+-- item_urls.txt (written by WgetArgs in pipeline.py), discovered URLs
+-- inherit the item of the page they were found on.
+local url_items = {}
+local item_count = 0
+-- Items of the batch that were given up on, see item_failed.
+local failed_items = {}
+
+-- See the URL plan section below.
+local url_plan_index = os.getenv('url_plan_index')
+local plan_stats = {}
+local plan_deltas = {}
+local planned = {}
+local planned_wallpapers = {}
+local unseen_wallpapers = {}
+
+-- Status of the last response, for get_urls.
+local last_status_code = nil
+
+-- See the resume section below.
+local done_urls = {}
+local manifest = nil
 
 
 read_file = function(file)
@@ -17,6 +41,376 @@ read_file = function(file)
   end
 end
 
+load_item_urls = function()
+  if not item_dir then
+    return
+  end
+  local f = io.open(item_dir .. "/item_urls.txt")
+  if not f then
+    return
+  end
+  local seen = {}
+  for line in f:lines() do
+    local item_name, item_url = string.match(line, "^([^\t]+)\t(.+)$")
+    if item_name then
+      url_items[item_url] = item_name
+      if not seen[item_name] then
+        seen[item_name] = true
+        item_count = item_count + 1
+      end
+    end
+  end
+  f:close()
+end
+
+-- Failed items are picked up by DropFailedItems in pipeline.py, which
+-- sends them back to the tracker. Their URLs that are found later are
+-- not fetched, so the WARC does not get a partial copy of them.
+item_failed = function(item_name)
+  failed_items[item_name] = true
+  local f = assert(io.open(item_dir .. "/failed_items.txt", "a"))
+  f:write(item_name .. "\n")
+  f:close()
+end
+
+is_failed_url = function(url)
+  local item_name = url_items[url]
+  return item_name ~= nil and failed_items[item_name] == true
+end
+
+load_item_urls()
+
+-- The category and extension of a wallpaper's full-size image (and so
+-- its thumbnails) can't be told from its id. Instead of requesting
+-- every variant, they are planned here: the wallpaper page names the
+-- image, and when it doesn't the variants are tried one at a time,
+-- most likely first, until one resolves. How likely a variant is comes
+-- from hit counts shared between runs in the url_plan_index file.
+-- Only the wallpaper of an item is planned, not the neighbours its
+-- prev/next links lead to, and when the item's page is gone every
+-- variant is requested, as the item's URL list used to do.
+local categories = { "high-resolution", "manga-anime", "rozne" }
+local extensions = { "jpg", "png", "gif" }
+local thumb_hosts = { "origthumbs", "thumbs", "sthumbs" }
+
+load_plan_stats = function()
+  local stats = {}
+  if url_plan_index then
+    local f = io.open(url_plan_index)
+    if f then
+      local ok, data = pcall(function() return JSON:decode(f:read("*all")) end)
+      f:close()
+      if ok and type(data) == "table" then
+        stats = data
+      end
+    end
+  end
+  return stats
+end
+
+-- Other wget processes use the index as well, so we never write it
+-- here: each run appends its own counts to url_plan_deltas.jsonl in the
+-- item directory, and UpdateUrlPlanIndex in pipeline.py adds them to the
+-- index under a lock.
+save_plan_stats = function()
+  if not item_dir or next(plan_deltas) == nil then
+    return
+  end
+  local f = io.open(item_dir .. "/url_plan_deltas.jsonl", "a")
+  if f then
+    f:write(JSON:encode(plan_deltas) .. "\n")
+    f:close()
+  end
+  plan_deltas = {}
+end
+
+record_plan_result = function(key, hit)
+  for _, counts in pairs({ plan_stats, plan_deltas }) do
+    local entry = counts[key] or { hits=0, tries=0 }
+    entry["tries"] = entry["tries"] + 1
+    if hit then
+      entry["hits"] = entry["hits"] + 1
+    end
+    counts[key] = entry
+  end
+end
+
+plan_score = function(key)
+  local entry = plan_stats[key] or { hits=0, tries=0 }
+  return (entry["hits"] + 1) / (entry["tries"] + 2)
+end
+
+-- Sorts keys by score, keeping the given order between equal scores.
+rank_keys = function(keys)
+  local ranked = {}
+  for i, key in ipairs(keys) do
+    table.insert(ranked, { key=key, score=plan_score(key), index=i })
+  end
+  table.sort(ranked, function(a, b)
+    if a.score ~= b.score then
+      return a.score > b.score
+    end
+    return a.index < b.index
+  end)
+  local result = {}
+  for _, entry in ipairs(ranked) do
+    table.insert(result, entry.key)
+  end
+  return result
+end
+
+full_url = function(wallpaper_id, category, extension)
+  return "http://wallpapers.wallbase.cc/" .. category .. "/wallpaper-" .. wallpaper_id .. "." .. extension
+end
+
+thumb_url = function(wallpaper_id, host, category, double_slash)
+  local slash = "/"
+  if double_slash then
+    slash = "//"
+  end
+  return "http://" .. host .. ".wallbase.cc" .. slash .. category .. "/thumb-" .. wallpaper_id .. ".jpg"
+end
+
+plan_url = function(urls, url, step)
+  planned[url] = step
+  table.insert(urls, { url=url })
+end
+
+-- All thumbnails of a wallpaper whose category is known, except the
+-- ones already probed.
+plan_thumbs = function(urls, wallpaper_id, category)
+  for _, double_slash in ipairs({ true, false }) do
+    for _, host in ipairs(thumb_hosts) do
+      local url = thumb_url(wallpaper_id, host, category, double_slash)
+      if not planned[url] then
+        plan_url(urls, url, { key="thumb/" .. host .. "/" .. category })
+      end
+    end
+  end
+end
+
+plan_thumb_probe = function(urls, wallpaper_id, candidates, index)
+  local key = candidates[index]
+  if key then
+    local host, category = string.match(key, "^thumb/([^/]+)/([^/]+)$")
+    plan_url(urls, thumb_url(wallpaper_id, host, category, false),
+      { key=key, wallpaper_id=wallpaper_id, candidates=candidates, index=index })
+  end
+end
+
+plan_full_probe = function(urls, wallpaper_id, candidates, index)
+  local key = candidates[index]
+  if key then
+    local category, extension = string.match(key, "^full/(.+)/(%a+)$")
+    plan_url(urls, full_url(wallpaper_id, category, extension),
+      { key=key, wallpaper_id=wallpaper_id, candidates=candidates, index=index })
+  else
+    -- No full-size image at all, try to find the thumbnails on their
+    -- own, on every thumbnail host.
+    local thumb_keys = {}
+    for _, category in ipairs(categories) do
+      for _, host in ipairs(thumb_hosts) do
+        table.insert(thumb_keys, "thumb/" .. host .. "/" .. category)
+      end
+    end
+    plan_thumb_probe(urls, wallpaper_id, rank_keys(thumb_keys), 1)
+  end
+end
+
+plan_wallpaper = function(urls, wallpaper_id, page)
+  if planned_wallpapers[wallpaper_id] then
+    return
+  end
+  planned_wallpapers[wallpaper_id] = true
+
+  local image = page["images"][wallpaper_id]
+  if image then
+    local category, extension = image["category"], image["extension"]
+    plan_url(urls, full_url(wallpaper_id, category, extension), { key="full/" .. category .. "/" .. extension })
+    plan_thumbs(urls, wallpaper_id, category)
+  else
+    local full_keys = {}
+    for _, extension in ipairs(extensions) do
+      for _, category in ipairs(categories) do
+        table.insert(full_keys, "full/" .. category .. "/" .. extension)
+      end
+    end
+    plan_full_probe(urls, wallpaper_id, rank_keys(full_keys), 1)
+  end
+end
+
+-- For a wallpaper item whose page did not come back with a 200.
+plan_all_variants = function(urls, wallpaper_id)
+  if planned_wallpapers[wallpaper_id] then
+    return
+  end
+  planned_wallpapers[wallpaper_id] = true
+
+  local variants = {}
+  for _, extension in ipairs(extensions) do
+    for _, category in ipairs(categories) do
+      plan_url(variants, full_url(wallpaper_id, category, extension), { key="full/" .. category .. "/" .. extension })
+    end
+  end
+  for _, category in ipairs(categories) do
+    plan_thumbs(variants, wallpaper_id, category)
+  end
+
+  -- get_urls may be looking at a page of another item by now.
+  for _, variant in ipairs(variants) do
+    url_items[variant["url"]] = "wallpaper:" .. wallpaper_id
+    table.insert(urls, variant)
+  end
+end
+
+-- Called from get_urls once a planned URL has been fetched.
+continue_plan = function(urls, url)
+  local step = planned[url]
+  if not step or not step["candidates"] or step["status"] == nil then
+    return
+  end
+  local wallpaper_id = step["wallpaper_id"]
+  local hit = step["status"] == 200
+
+  if string.match(step["key"], "^full/") then
+    if hit then
+      plan_thumbs(urls, wallpaper_id, string.match(step["key"], "^full/(.+)/"))
+    elseif step["status"] == 404 then
+      plan_full_probe(urls, wallpaper_id, step["candidates"], step["index"] + 1)
+    end
+  else
+    if hit then
+      plan_thumbs(urls, wallpaper_id, string.match(step["key"], "^thumb/[^/]+/([^/]+)$"))
+    elseif step["status"] == 404 then
+      plan_thumb_probe(urls, wallpaper_id, step["candidates"], step["index"] + 1)
+    end
+  end
+end
+
+plan_stats = load_plan_stats()
+
+-- Per-host rate control. Every host has a token bucket whose rate is
+-- raised a little after each quick, successful response and halved on
+-- 5xx/429/0 responses or slow ones (AIMD). The wallbase.cc pages start
+-- out slow, the image hosts at full speed.
+--
+-- This needs luasocket, for a clock and for sleeping without forking.
+-- Wget+Lua builds without it (wget-lua-warrior is one) say so at the
+-- start of every run, and the script never sleeps: the requests are
+-- paced by Wget alone, with the --wait and --random-wait that
+-- pipeline.py passes (WGET_WAIT there), and a retry after an error
+-- waits as long as Wget's --waitretry makes it. With luasocket, the
+-- script only sleeps for the part of a wait Wget does not do itself.
+local socket_ok, socket = pcall(require, "socket")
+
+local host_limits = {
+  ["wallbase.cc"] = { rate=2, min_rate=0.2, max_rate=5 },
+  ["walb.es"] = { rate=2, min_rate=0.2, max_rate=5 },
+}
+local default_host_limits = { rate=50, min_rate=1, max_rate=100 }
+-- Fraction of a host's max_rate added after each good response.
+local rate_increase = 0.01
+-- Seconds a download may take before its host counts as slow.
+local slow_response = 5
+local rate_log_interval = 60
+-- Wget waits at least half of --wait before every request (because of
+-- --random-wait), and n seconds, at most --waitretry, before the n-th
+-- retry of a URL. Has to match WgetArgs in pipeline.py.
+local wget_min_wait = (tonumber(os.getenv("wget_wait")) or 0) / 2
+local wget_waitretry = 30
+
+if not socket_ok then
+  io.stdout:write("luasocket is not available, per-host rate control is off. Wget's --wait paces the requests.\n")
+  io.stdout:flush()
+end
+
+local hosts = {}
+local last_rate_log = nil
+
+now = function()
+  if socket_ok then
+    return socket.gettime()
+  else
+    return os.time()
+  end
+end
+
+-- Does nothing without luasocket.
+sleep = function(seconds)
+  if socket_ok and seconds > 0.001 then
+    socket.sleep(seconds)
+  end
+end
+
+get_host = function(name)
+  local host = hosts[name]
+  if not host then
+    local limits = host_limits[name] or default_host_limits
+    host = {
+      name=name,
+      rate=limits["rate"],
+      min_rate=limits["min_rate"],
+      max_rate=limits["max_rate"],
+      tokens=1,
+      updated=now(),
+      requests=0,
+      errors=0,
+      started=now()
+    }
+    hosts[name] = host
+  end
+  return host
+end
+
+-- Returns the number of seconds to wait before the next request to this
+-- host.
+take_token = function(host)
+  if not socket_ok then
+    return 0
+  end
+  local t = now()
+  host["tokens"] = math.min(1, host["tokens"] + (t - host["updated"]) * host["rate"])
+  host["updated"] = t
+  host["tokens"] = host["tokens"] - 1
+  if host["tokens"] < 0 then
+    return -host["tokens"] / host["rate"]
+  end
+  return 0
+end
+
+host_succeeded = function(host, seconds)
+  host["requests"] = host["requests"] + 1
+  if seconds and seconds > slow_response then
+    host["rate"] = math.max(host["min_rate"], host["rate"] / 2)
+  else
+    host["rate"] = math.min(host["max_rate"], host["rate"] + host["max_rate"] * rate_increase)
+  end
+end
+
+host_failed = function(host)
+  host["requests"] = host["requests"] + 1
+  host["errors"] = host["errors"] + 1
+  host["rate"] = math.max(host["min_rate"], host["rate"] / 2)
+end
+
+log_host_rates = function(force)
+  local t = now()
+  if not last_rate_log then
+    last_rate_log = t
+  end
+  if not force and t - last_rate_log < rate_log_interval then
+    return
+  end
+  last_rate_log = t
+  io.stdout:write("\n")
+  for name, host in pairs(hosts) do
+    local elapsed = math.max(1, t - host["started"])
+    io.stdout:write(string.format("Rate %s: %.2f req/s (limit %.2f req/s, %d requests, %d errors)\n",
+      name, host["requests"] / elapsed, host["rate"], host["requests"], host["errors"]))
+  end
+  io.stdout:flush()
+end
+
 -- wget.callbacks.download_child_p = function(urlpos, parent, depth, start_url_parsed, iri, verdict, reason)
 --   local url = urlpos["url"]["url"]
 --   
@@ -29,164 +423,392 @@ end
 --   end
 -- end
 
-wget.callbacks.get_urls = function(file, url, is_css, iri)
-  local urls = {}
-  local html = nil
-  
-  --example url: http://wallbase.cc/wallpaper/2816669
-  if string.match(url, "wallbase%.cc/wallpaper/") then
-    if not html then
-      html = read_file(file)
+wget.callbacks.download_child_p = function(urlpos, parent, depth, start_url_parsed, iri, verdict, reason)
+  local url = urlpos["url"]["url"]
+  if done_urls[url] or is_failed_url(url) or is_failed_url(parent["url"]) then
+    return false
+  end
+  return verdict
+end
+
+-- Reads a page and scans it once for everything the routes below need:
+-- the wallpaper prev/next links, the full-size images it shows and the
+-- end-of-list markers of search pages.
+scan_page = function(file)
+  local page = { links={}, images={}, the_end=false, nothing_here=false }
+  local html = read_file(file)
+
+  for tag, attrs, text in string.gmatch(html, "<(%a+)([^>]*)>([^<]*)") do
+    if tag == "a" then
+      --example line: <a href="http://wallbase.cc/wallpaper/go/2816669/prev?ref=aHR0cDovL3dhbGxiYXNlLmNjL2NvbGxlY3Rpb24vMjkwNTUv" class="prev-wall"><span class="icn">&#x2190;</span> PREV</a>
+      local href, class = string.match(attrs, '^ href="(http://wallbase%.cc/wallpaper/go/[0-9]+/[a-z]+%?ref=[a-zA-Z0-9]+)" class="([a-z]+)%-wall"')
+      if href and (class == "prev" or class == "next") then
+        table.insert(page["links"], href)
+      end
+    elseif tag == "img" then
+      --example line: <img src="http://wallpapers.wallbase.cc/rozne/wallpaper-2940947.jpg" ...
+      local category, wallpaper_id, extension = string.match(attrs, 'src="http://wallpapers%.wallbase%.cc/([%a%-]+)/wallpaper%-([0-9]+)%.(%a+)"')
+      if category then
+        page["images"][wallpaper_id] = { category=category, extension=extension }
+      end
+    elseif tag == "div" then
+      if text == "The End" and attrs == ' class="title"' then
+        page["the_end"] = true
+      elseif text == "There seems to be nothing here. Move along..." and attrs == ' class="subtitle"' then
+        page["nothing_here"] = true
+      end
     end
-    
-    --example line: <a href="http://wallbase.cc/wallpaper/go/2816669/prev?ref=aHR0cDovL3dhbGxiYXNlLmNjL2NvbGxlY3Rpb24vMjkwNTUv" class="prev-wall"><span class="icn">&#x2190;</span> PREV</a>
-    --url to extract from example line: http://wallbase.cc/wallpaper/go/2816669/prev?ref=aHR0cDovL3dhbGxiYXNlLmNjL2NvbGxlY3Rpb24vMjkwNTUv
-    local prev_url = string.match(html, '<a href="(http://wallbase%.cc/wallpaper/go/[0-9]+/prev%?ref%=[a-x0-9A-X]+)" class="prev-wall">')
-    if prev_url then
-      table.insert(urls, { url=prev_url })
+  end
+
+  return page
+end
+
+-- The images are only planned and the prev/next links only followed
+-- from the page of a wallpaper item itself. The links lead to the
+-- neighbouring wallpapers, whose pages have prev/next links of their
+-- own, so following those as well would walk the whole chain.
+is_item_wallpaper = function(wallpaper_id)
+  return url_items["http://wallbase.cc/wallpaper/" .. wallpaper_id] == "wallpaper:" .. wallpaper_id
+end
+
+-- Search pages are followed to the next offset until they are empty.
+has_more_results = function(page)
+  return last_status_code == 200 and not page["the_end"] and not page["nothing_here"]
+end
+
+-- Resuming. Every URL that made it into the WARC is appended to
+-- manifest.txt with its status. When WgetDownload retries an item,
+-- pipeline.py starts a new WARC segment and leaves out the start URLs
+-- listed there; they are skipped here as well when they are found
+-- again. Pages on the wallbase.cc hosts are never listed: they are
+-- small, and fetching them again finds their links, URL plans and
+-- search pages again. Neither are redirects: the retry has to fetch
+-- them again to get to their target.
+local page_hosts = { ["wallbase.cc"]=true, ["walb.es"]=true }
+
+load_manifest = function()
+  if not item_dir then
+    return
+  end
+  local f = io.open(item_dir .. "/manifest.txt")
+  if f then
+    for line in f:lines() do
+      local status_code, done_url = string.match(line, "^([0-9]+) (.+)$")
+      if status_code then
+        done_urls[done_url] = tonumber(status_code)
+      end
     end
-    
-    --example line: <a href="http://wallbase.cc/wallpaper/go/2816669/next?ref=aHR0cDovL3dhbGxiYXNlLmNjL2NvbGxlY3Rpb24vMjkwNTUv" class="next-wall">NEXT <span class="icn">&#x2192;</span></a>
-    --url to extract from example line: http://wallbase.cc/wallpaper/go/2816669/next?ref=aHR0cDovL3dhbGxiYXNlLmNjL2NvbGxlY3Rpb24vMjkwNTUv
-    local next_url = string.match(html, '<a href="(http://wallbase%.cc/wallpaper/go/[0-9]+/next%?ref%=[a-z0-9A-Z]+)" class="prev-wall">')
-    if next_url then
-      table.insert(urls, { url=next_url })
+    f:close()
+  end
+  manifest = assert(io.open(item_dir .. "/manifest.txt", "a"))
+
+  -- Every attempt decides again which items failed.
+  os.remove(item_dir .. "/failed_items.txt")
+end
+
+url_written = function(url, status_code)
+  if manifest and not page_hosts[url["host"]] and
+      (status_code < 300 or status_code >= 400) then
+    manifest:write(status_code .. " " .. url["url"] .. "\n")
+    manifest:flush()
+  end
+end
+
+-- Drops the URLs an earlier attempt already has, following the URL plan
+-- past them as if they had just been fetched.
+skip_done_urls = function(urls)
+  local result = {}
+  local i = 1
+  while urls[i] do
+    local newurl = urls[i]["url"]
+    if done_urls[newurl] then
+      if planned[newurl] then
+        planned[newurl]["status"] = done_urls[newurl]
+        continue_plan(urls, newurl)
+      end
+    else
+      table.insert(result, urls[i])
     end
+    i = i + 1
   end
-  
+  return result
+end
+
+load_manifest()
+
+-- Pagination of search results. The next page is queued once this one
+-- turns out to have results; the pages do not tell how many there are,
+-- so queueing further ahead could go past the end.
+local queued_pages = {}
+
+plan_pages = function(urls, page, prefix, offset, suffix, step)
+  if not has_more_results(page) then
+    return
+  end
+  local url = prefix .. (tonumber(offset) + step) .. suffix
+  if not queued_pages[url] then
+    queued_pages[url] = true
+    table.insert(urls, { url=url })
+  end
+end
+
+-- Every URL shape we extract links from, with the handler that does it.
+-- The captures of the pattern are passed to the handler after the
+-- list of new URLs and the scanned page.
+local routes = {
+  --example url: http://wallbase.cc/wallpaper/2816669
+  {
+    pattern="^http://wallbase%.cc/wallpaper/([0-9]+)$",
+    handler=function(urls, page, wallpaper_id)
+      if not is_item_wallpaper(wallpaper_id) then
+        return
+      end
+      if last_status_code == 200 then
+        plan_wallpaper(urls, wallpaper_id, page)
+      end
+      for _, link in ipairs(page["links"]) do
+        table.insert(urls, { url=link })
+      end
+    end
+  },
   --example url: http://wallbase.cc/search?tag=8179
-  if string.match(url, "wallbase%.cc/search%?tag=[0-9]+") then
-    if not html then
-      html = read_file(file)
-    end
-    
-    if not string.match(html, '<div class="title">The End</div>') and
-      string.match(html, '<div class="subtitle">There seems to be nothing here%. Move along%.%.%.</div>') then
-      local tag_number = string.match(url, "wallbase%.cc/search%?tag=([0-9]+)")
-      
-      tag_wallpaper_number_zero = 0
-      tag_wallpaper_number_new_url1 = "http://wallbase.cc/search/"..tag_wallpaper_number_zero.."?tag="..tag_number
-      tag_wallpaper_number_new_url2 = "http://wallbase.cc/search/index/"..tag_wallpaper_number_zero.."?tag="..tag_number
-      
-      table.insert(urls, { url=tag_wallpaper_number_new_url1 })
-      table.insert(urls, { url=tag_wallpaper_number_new_url2 })
+  {
+    pattern="^http://wallbase%.cc/search%?tag=([0-9]+)",
+    handler=function(urls, page, tag_number)
+      if has_more_results(page) then
+        table.insert(urls, { url="http://wallbase.cc/search/0?tag=" .. tag_number })
+        table.insert(urls, { url="http://wallbase.cc/search/index/0?tag=" .. tag_number })
+      end
     end
+  },
   --example url: http://wallbase.cc/search?q==%28fate%20stay%20night%29&color=&section=wallpapers&q==%28fate%20stay%20night%29&res_opt=eqeq&res=0x0&order_mode=desc&thpp=32&purity=100&board=21&aspect=0.00
-  elseif string.match(url, "wallbase%.cc/search%?tag==.+") then
-    if not html then
-      html = read_file(file)
+  {
+    pattern="^http://wallbase%.cc/search%?q==(.+)",
+    handler=function(urls, page, query)
+      if has_more_results(page) then
+        table.insert(urls, { url="http://wallbase.cc/search/index/0?q==" .. query })
+      end
     end
-    
-    if not string.match(html, '<div class="title">The End</div>') and
-      string.match(html, '<div class="subtitle">There seems to be nothing here%. Move along%.%.%.</div>') then
-      local tag_string = string.match(url, "wallbase%.cc/search%?tag==(.+)")
-      
-      tag_wallpaper_number_zero = 0
-      tag_wallpaper_number_new_url = "http://wallbase.cc/search/index/"..tag_wallpaper_number_zero.."?q=="..tag_string
-      
-      table.insert(urls, { url=tag_wallpaper_number_new_url })
+  },
+  --example url: http://wallbase.cc/search/60?tag=8179
+  {
+    pattern="^http://wallbase%.cc/search/([0-9]+)%?tag=([0-9]+)",
+    handler=function(urls, page, offset, tag_number)
+      plan_pages(urls, page, "http://wallbase.cc/search/", offset, "?tag=" .. tag_number, 60)
     end
+  },
+  --example url: http://wallbase.cc/search/index/0?tag=8179
+  {
+    pattern="^http://wallbase%.cc/search/index/([0-9]+)%?tag=([0-9]+)",
+    handler=function(urls, page, offset, tag_number)
+      plan_pages(urls, page, "http://wallbase.cc/search/index/", offset, "?tag=" .. tag_number, 32)
+    end
+  },
+  --example url: http://wallbase.cc/search/index/64?q==%28fate%20stay%20night%29&color=&section=wallpapers&q==%28fate%20stay%20night%29&res_opt=eqeq&res=0x0&order_mode=desc&thpp=32&purity=100&board=21&aspect=0.00
+  {
+    pattern="^http://wallbase%.cc/search/index/([0-9]+)%?q==(.+)",
+    handler=function(urls, page, offset, query)
+      plan_pages(urls, page, "http://wallbase.cc/search/index/", offset, "?q==" .. query, 32)
+    end
+  },
+}
+
+wget.callbacks.get_urls = function(file, url, is_css, iri)
+  local urls = {}
+  local page = nil
+  
+  if is_failed_url(url) then
+    return urls
   end
   
-  --example url: http://wallbase.cc/search/60?tag=8179
-  if string.match(url, "wallbase%.cc/search/[0-9]+%?tag=[0-9]+") then
-    if not html then
-      html = read_file(file)
-    end
-    
-    if not string.match(html, '<div class="title">The End</div>') and
-      string.match(html, '<div class="subtitle">There seems to be nothing here%. Move along%.%.%.</div>') then
-      local tag_wallpaper_number = string.match(url, "wallbase%.cc/search/([0-9]+)%?tag=[0-9]+")
-      local tag_number = string.match(url, "wallbase%.cc/search/[0-9]+%?tag=([0-9]+)")
-      
-      tag_wallpaper_number_new = tag_wallpaper_number + 60
-      tag_wallpaper_number_new_url = "http://wallbase.cc/search/"..tag_wallpaper_number_new.."?tag="..tag_number
-      
-      table.insert(urls, { url=tag_wallpaper_number_new_url })
-    end
+  continue_plan(urls, url)
+  
+  for wallpaper_id in pairs(unseen_wallpapers) do
+    plan_all_variants(urls, wallpaper_id)
   end
+  unseen_wallpapers = {}
   
-  --example url: http://wallbase.cc/search/index/0?tag=8179
-  if string.match(url, "wallbase%.cc/search/index/[0-9]+%?tag=[0-9]+") then
-    if not html then
-      html = read_file(file)
-    end
-    
-    if not string.match(html, '<div class="title">The End</div>') and
-      string.match(html, '<div class="subtitle">There seems to be nothing here%. Move along%.%.%.</div>') then
-      local tag_wallpaper_number = string.match(url, "wallbase%.cc/search/index/([0-9]+)%?tag=[0-9]+")
-      local tag_number = string.match(url, "wallbase%.cc/search/index/[0-9]+%?tag=([0-9]+)")
-      
-      tag_wallpaper_number_new = tag_wallpaper_number + 32
-      tag_wallpaper_number_new_url = "http://wallbase.cc/search/index/"..tag_wallpaper_number_new.."?tag="..tag_number
-      
-      table.insert(urls, { url=tag_wallpaper_number_new_url })
+  for _, route in ipairs(routes) do
+    local captures = { string.match(url, route["pattern"]) }
+    if captures[1] then
+      if not page then
+        page = scan_page(file)
+      end
+      route["handler"](urls, page, unpack(captures))
     end
   end
   
-  --example url: http://wallbase.cc/search/index/64?q==%28fate%20stay%20night%29&color=&section=wallpapers&q==%28fate%20stay%20night%29&res_opt=eqeq&res=0x0&order_mode=desc&thpp=32&purity=100&board=21&aspect=0.00
-  if string.match(url, "wallbase%.cc/search/index/[0-9]+%?q==.+") then
-    if not html then
-      html = read_file(file)
-    end
-    
-    if not string.match(html, '<div class="title">The End</div>') and
-      string.match(html, '<div class="subtitle">There seems to be nothing here%. Move along%.%.%.</div>') then
-      local tag_wallpaper_number = string.match(url, "wallbase%.cc/search/index/([0-9]+)%?q==.+")
-      local tag_string = string.match(url, "wallbase%.cc/search/index/[0-9]+%?q==(.+)")
-      
-      tag_wallpaper_number_new = tag_wallpaper_number + 32
-      tag_wallpaper_number_new_url = "http://wallbase.cc/search/index/"..tag_wallpaper_number_new.."?q=="..tag_string
-      
-      table.insert(urls, { url=tag_wallpaper_number_new_url })
+  urls = skip_done_urls(urls)
+  
+  local item_name = url_items[url]
+  if item_name then
+    for _, newurl in pairs(urls) do
+      if not url_items[newurl["url"]] then
+        url_items[newurl["url"]] = item_name
+      end
     end
   end
   
-  --example url: http://wallbase.cc/search?q==%28fate%20stay%20night%29&color=&section=wallpapers&q==%28fate%20stay%20night%29&res_opt=eqeq&res=0x0&order_mode=desc&thpp=32&purity=100&board=21&aspect=0.00
-  if string.match(url, )
+  -- A URL found here may already belong to an item that failed.
+  local result = {}
+  for _, newurl in ipairs(urls) do
+    if not is_failed_url(newurl["url"]) then
+      table.insert(result, newurl)
+    end
+  end
+
+  return result
+end
+
+-- URL metrics. Counts, bytes, status codes and a histogram of Wget's
+-- download times of the URLs of this wget run. They are appended to
+-- url_metrics.jsonl in the item directory when wget finishes or gives
+-- up; CollectUrlMetrics in pipeline.py adds them to the pipeline's
+-- metrics file.
+-- Has to match Metrics.URL_BUCKETS in pipeline.py.
+local latency_bounds = { 0.1, 0.25, 0.5, 1, 2.5, 5, 10 }
+
+new_url_metrics = function()
+  local metrics = {
+    urls=0,
+    bytes=0,
+    status_codes={},
+    latency_buckets={},
+    latency_sum=0,
+  }
+  for i = 1, #latency_bounds + 1 do
+    metrics["latency_buckets"][i] = 0
+  end
+  return metrics
+end
+
+local url_metrics = new_url_metrics()
+
+record_url_metrics = function(status_code, bytes, latency)
+  url_metrics["urls"] = url_metrics["urls"] + 1
+  url_metrics["bytes"] = url_metrics["bytes"] + (bytes or 0)
+
+  -- String keys, so JSON.lua encodes an object.
+  local key = tostring(status_code)
+  url_metrics["status_codes"][key] = (url_metrics["status_codes"][key] or 0) + 1
+
+  if latency then
+    local bucket = #latency_bounds + 1
+    for i, bound in ipairs(latency_bounds) do
+      if latency <= bound then
+        bucket = i
+        break
+      end
+    end
+    url_metrics["latency_buckets"][bucket] = url_metrics["latency_buckets"][bucket] + 1
+    url_metrics["latency_sum"] = url_metrics["latency_sum"] + latency
+  end
 end
 
+write_url_metrics = function()
+  if not item_dir or url_metrics["urls"] == 0 then
+    return
+  end
+  local f = io.open(item_dir .. "/url_metrics.jsonl", "a")
+  if f then
+    f:write(JSON:encode(url_metrics) .. "\n")
+    f:close()
+  end
+  url_metrics = new_url_metrics()
+end
+
+
 wget.callbacks.httploop_result = function(url, err, http_stat)
   -- NEW for 2014: Slightly more verbose messages because people keep
   -- complaining that it's not moving or not working
   local status_code = http_stat["statcode"]
+  last_status_code = status_code
+  
+  local item_name = url_items[url["url"]]
+
+  if item_name and http_stat["newloc"] and not url_items[http_stat["newloc"]] then
+    url_items[http_stat["newloc"]] = item_name
+  end
+  
+  local step = planned[url["url"]]
+  if step and (status_code == 200 or status_code == 404) then
+    step["status"] = status_code
+    record_plan_result(step["key"], status_code == 200)
+  end
   
   url_count = url_count + 1
   io.stdout:write(url_count .. "=" .. status_code .. " " .. url["url"] .. ".  \r")
   io.stdout:flush()
   
+  local host = get_host(url["host"])
+  -- Wget's own timing of the download, in seconds.
+  record_url_metrics(status_code, http_stat["len"], http_stat["dltime"])
+
   if status_code >= 500 or
     (status_code >= 400 and status_code ~= 404) or
     status_code == 0 then
-    io.stdout:write("\nServer returned "..http_stat.statcode..". Sleeping.\n")
-    io.stdout:flush()
+    host_failed(host)
 
-    os.execute("sleep 10")
+    if is_failed_url(url["url"]) then
+      -- Queued before its item failed; not worth retrying.
+      return wget.actions.EXIT
+    end
 
     tries = tries + 1
 
-    if tries >= 5 then
+    io.stdout:write("\nServer returned "..http_stat.statcode..".\n")
+    io.stdout:flush()
+
+    if tries >= 5 and item_count > 1 and item_name then
+      -- Only this item of the batch fails, the others carry on.
+      io.stdout:write("\nGiving up on " .. item_name .. "...\n")
+      io.stdout:flush()
+      item_failed(item_name)
+      tries = 0
+      save_plan_stats()
+      write_url_metrics()
+      return wget.actions.EXIT
+    elseif tries >= 5 then
       io.stdout:write("\nI give up...\n")
       io.stdout:flush()
+      -- Wget does not call finish after an abort. The pipeline still
+      -- needs the errors, to quarantine the bind address.
+      save_plan_stats()
+      write_url_metrics()
       return wget.actions.ABORT
     else
+      local wget_wait = math.min(tries, wget_waitretry)
+      local wait_time = 0
+      if socket_ok then
+        wait_time = math.max(0, math.max(take_token(host), math.min(60, 2 ^ tries)) - wget_wait)
+      end
+      io.stdout:write("Retrying in " .. (wait_time + wget_wait) .. " seconds.\n")
+      io.stdout:flush()
+      sleep(wait_time)
       return wget.actions.CONTINUE
     end
   end
 
   tries = 0
 
-  -- We're okay; sleep a bit (if we have to) and continue
-  local sleep_time = 0.1 * (math.random(75, 1000) / 100.0)
-
-  --  if string.match(url["host"], "cdn") or string.match(url["host"], "media") then
-  --    -- We should be able to go fast on images since that's what a web browser does
-  --    sleep_time = 0
-  --  end
-
-  if sleep_time > 0.001 then
-    os.execute("sleep " .. sleep_time)
+  -- We're okay; wait if this host needs it and continue
+  url_written(url, status_code)
+  -- A gone or hidden wallpaper page may still have its images; they are
+  -- planned in the next get_urls, which for a redirect is that of its
+  -- target.
+  local wallpaper_id = string.match(url["url"], "^http://wallbase%.cc/wallpaper/([0-9]+)$")
+  if wallpaper_id and status_code ~= 200 and is_item_wallpaper(wallpaper_id) then
+    unseen_wallpapers[wallpaper_id] = true
   end
+  host_succeeded(host, http_stat["dltime"])
+  sleep(take_token(host) - wget_min_wait)
+  log_host_rates(false)
 
   return wget.actions.NOTHING
 end
+
+wget.callbacks.finish = function(start_time, end_time, wall_time, numurls, total_downloaded_bytes, total_download_time)
+  save_plan_stats()
+  log_host_rates(true)
+  write_url_metrics()
+end
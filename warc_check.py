@@ -0,0 +1,234 @@
+# encoding=utf8
+'''
+Checks the .warc.gz files Wget writes and indexes them as CDXJ.
+
+This runs in the process pool of pipeline.py (see CheckWarc there), so
+it has to be importable on its own and only uses the standard library.
+'''
+import base64
+import hashlib
+import json
+import os.path
+import struct
+import zlib
+
+
+CHUNK_SIZE = 1024 * 1024
+INDEXED_WARC_TYPES = ('response', 'revisit', 'resource')
+
+
+class WarcError(Exception):
+    pass
+
+
+def read_members(filename):
+    '''
+    Yields (offset, length, data) for every gzip member of a file, one
+    member at a time. Raises WarcError for a corrupt or truncated one.
+    '''
+    with open(filename, 'rb') as f:
+        offset = 0
+        pending = f.read(CHUNK_SIZE)
+        while pending:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data = []
+            length = 0
+            tail = b''
+            while True:
+                try:
+                    data.append(decompressor.decompress(pending))
+                except zlib.error as e:
+                    raise WarcError('Corrupt gzip member at offset %d: %s' % (offset, e))
+                # Anything after the end of the member is left in
+                # unused_data (decompressobj has no eof before Python 3.3).
+                if decompressor.unused_data:
+                    length += len(pending) - len(decompressor.unused_data)
+                    pending = decompressor.unused_data
+                    break
+                length += len(pending)
+                tail = (tail + pending)[-8:]
+                pending = f.read(CHUNK_SIZE)
+                if not pending:
+                    # The member runs to the end of the file, so it is
+                    # only complete if it ends with its own trailer.
+                    if not member_complete(b''.join(data), tail):
+                        raise WarcError('Truncated gzip member at offset %d.' % offset)
+                    break
+
+            yield offset, length, b''.join(data)
+            offset += length
+            if not pending:
+                pending = f.read(CHUNK_SIZE)
+
+
+def member_complete(data, tail):
+    '''
+    Whether tail, the last bytes of a gzip member, is the trailer of
+    data: its CRC-32 and its length modulo 2**32.
+    '''
+    if len(tail) < 8:
+        return False
+    return struct.unpack('<II', tail) == (
+        zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+
+
+def read_records(data, offset):
+    '''
+    Yields (headers, block) for the WARC records in the data of a gzip
+    member. Raises WarcError if they are not well-formed.
+    '''
+    while data:
+        header_end = data.find(b'\r\n\r\n')
+        if not data.startswith(b'WARC/') or header_end < 0:
+            raise WarcError('No WARC record at offset %d.' % offset)
+
+        headers = {}
+        for line in data[:header_end].decode('utf-8', 'replace').split('\r\n')[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip()] = value.strip()
+        for name in ('WARC-Type', 'WARC-Record-ID', 'WARC-Date', 'Content-Length'):
+            if name not in headers:
+                raise WarcError('WARC record at offset %d has no %s.' % (offset, name))
+
+        block_start = header_end + 4
+        block_end = block_start + int(headers['Content-Length'])
+        block = data[block_start:block_end]
+        if len(block) != int(headers['Content-Length']) or \
+                data[block_end:block_end + 4] != b'\r\n\r\n':
+            raise WarcError('WARC record at offset %d does not match its Content-Length.' % offset)
+
+        digest = headers.get('WARC-Block-Digest', '')
+        if digest.startswith('sha1:') and digest[5:] != \
+                base64.b32encode(hashlib.sha1(block).digest()).decode('ascii'):
+            raise WarcError('WARC record at offset %d does not match its WARC-Block-Digest.' % offset)
+
+        yield headers, block
+        data = data[block_end + 4:]
+
+
+def parse_http_response(block):
+    '''Returns the status code and MIME type of an HTTP response.'''
+    head = block.split(b'\r\n\r\n', 1)[0].decode('iso-8859-1').split('\r\n')
+    status_line = head[0].split(' ')
+    if not head[0].startswith('HTTP/') or len(status_line) < 2:
+        return '-', '-'
+
+    mime_type = '-'
+    for line in head[1:]:
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'content-type':
+            mime_type = value.split(';')[0].strip().lower() or '-'
+    return status_line[1], mime_type
+
+
+def surt(url):
+    '''
+    The SURT form of a URL, e.g. cc,wallbase)/wallpaper/2816669 for
+    http://wallbase.cc/wallpaper/2816669.
+    '''
+    rest = url.split('://', 1)[-1]
+    host, _, path = rest.partition('/')
+    host = host.lower()
+    if host.endswith(':80'):
+        host = host[:-3]
+    if host.startswith('www.'):
+        host = host[4:]
+    return ','.join(reversed(host.split('.'))) + ')/' + path.lower()
+
+
+def check_warc(warc_file, index_file):
+    '''
+    Reads a .warc.gz file member by member, checks the gzip data and the
+    WARC records, writes a CDXJ index of the responses, revisits and
+    resources to index_file and counts the records by WARC type, HTTP
+    status code and MIME type.
+
+    Returns the counts, or {"error": message} if the file is broken.
+    '''
+    filename = os.path.basename(warc_file)
+    summary = {
+        'members': 0,
+        'records': 0,
+        'warc_types': {},
+        'status_codes': {},
+        'mime_types': {},
+    }
+    lines = []
+
+    try:
+        for offset, length, data in read_members(warc_file):
+            summary['members'] += 1
+            for headers, block in read_records(data, offset):
+                summary['records'] += 1
+                warc_type = headers['WARC-Type']
+                summary['warc_types'][warc_type] = summary['warc_types'].get(warc_type, 0) + 1
+                if warc_type not in INDEXED_WARC_TYPES:
+                    continue
+
+                if warc_type == 'resource':
+                    status_code = '-'
+                    mime_type = headers.get('Content-Type', '-').split(';')[0].strip()
+                else:
+                    status_code, mime_type = parse_http_response(block)
+                if warc_type == 'response':
+                    summary['status_codes'][status_code] = summary['status_codes'].get(status_code, 0) + 1
+                    summary['mime_types'][mime_type] = summary['mime_types'].get(mime_type, 0) + 1
+
+                url = headers.get('WARC-Target-URI', '')
+                timestamp = ''.join(c for c in headers['WARC-Date'] if c.isdigit())[:14]
+                lines.append('%s %s %s' % (surt(url), timestamp, json.dumps({
+                    'url': url,
+                    'mime': mime_type,
+                    'status': status_code,
+                    'digest': headers.get('WARC-Payload-Digest', '-'),
+                    'length': length,
+                    'offset': offset,
+                    'filename': filename,
+                }, sort_keys=True)))
+    except (WarcError, IOError, OSError) as e:
+        return {'error': str(e)}
+    except Exception as e:
+        return {'error': 'Could not check %s: %r' % (filename, e)}
+
+    lines.sort()
+    with open(index_file, 'w') as f:
+        for line in lines:
+            f.write(line + '\n')
+
+    return summary
+
+
+def check_warc_in_pool(warc_file, index_file):
+    '''
+    Runs check_warc in a process pool. Python 2's Pool.apply_async has
+    no error_callback and never calls back when the function raises, so
+    this always returns a result, {"error": message} if anything went
+    wrong.
+    '''
+    try:
+        return check_warc(warc_file, index_file)
+    except Exception as e:
+        return {'error': 'Could not check %s: %r' % (os.path.basename(warc_file), e)}
+
+
+def merge_indexes(index_files, warc_sizes, filename, merged_index_file):
+    '''
+    Merges the CDXJ indexes of WARCs that were concatenated into the
+    WARC filename, in that order, moving the offsets along.
+    '''
+    lines = []
+    base_offset = 0
+    for index_file, warc_size in zip(index_files, warc_sizes):
+        with open(index_file) as f:
+            for line in f:
+                key, timestamp, data = line.rstrip('\n').split(' ', 2)
+                data = json.loads(data)
+                data['offset'] += base_offset
+                data['filename'] = filename
+                lines.append('%s %s %s' % (key, timestamp, json.dumps(data, sort_keys=True)))
+        base_offset += warc_size
+
+    lines.sort()
+    with open(merged_index_file, 'w') as f:
+        for line in lines:
+            f.write(line + '\n')